@@ -0,0 +1,194 @@
+
+# Compressed archive of the users' speech audio
+#
+# Finished turns are saved by the conversation server as raw 16kHz pcm wav files: ./useraudiofile/{session_id}_{n:04d}.wav
+# The archiver transcodes them with ffmpeg (Opus by default, FLAC for lossless), checks that the result decodes to
+# the same duration, moves it to ./useraudiofile/archive/{YYYY}/{MM}/{DD}/{phone_id}/ and points context.audio_file_dir
+# at it before the wav is removed.
+#
+#   python audio_archive.py            archive every finished wav once and print the statistics
+#   (the conversation server also runs it in the background, see audio_archiver in test_server)
+
+
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+import wave
+
+import pymysql
+
+
+AUDIO_FILE_NAME = re.compile(r"^(?P<session_id>(?P<date>\d{8})\d{6}_(?P<phone_id>.+))_(?P<number>\d{4})\.wav$")
+
+# ffmpeg output options of each archive format (mono speech)
+ARCHIVE_FORMATS = {
+    "opus": ["-c:a", "libopus", "-b:a", "24k", "-application", "voip"],
+    "flac": ["-c:a", "flac", "-compression_level", "8"],
+}
+
+CONTEXT_ROW_EXISTS = """SELECT 1 FROM context
+                        WHERE session_id = %s AND unique_number = %s AND role = 'user' LIMIT 1;"""
+
+UPDATE_AUDIO_FILE_DIR = """UPDATE context SET audio_file_dir = %s
+                            WHERE session_id = %s AND unique_number = %s AND role = 'user';"""
+
+
+class AudioArchiver:
+    def __init__(self, pool, audio_dir="./useraudiofile", archive_format="opus", min_age=1800, orphan_age=86400, workers=2):
+        if archive_format not in ARCHIVE_FORMATS:
+            raise ValueError(f"unknown archive format: {archive_format}")
+        self.pool = pool
+        self.audio_dir = audio_dir
+        self.archive_dir = os.path.join(audio_dir, "archive")
+        self.archive_format = archive_format
+        self.min_age = min_age          # seconds since the last write before a wav counts as finished
+        self.orphan_age = orphan_age    # wavs without a context row are archived anyway after this long
+        self.workers = workers
+        self.enabled = shutil.which("ffmpeg") is not None and shutil.which("ffprobe") is not None
+        if not self.enabled:
+            print("Audio archive disabled: ffmpeg / ffprobe not found")
+
+        self.lock = threading.Lock()
+        self.files = 0
+        self.failures = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.audio_seconds = 0.0
+        self.busy_seconds = 0.0
+
+    def archive_path(self, match):
+        date = match.group("date")
+        phone_id = match.group("phone_id").replace(os.sep, "_")
+        file_name = f"{match.group('session_id')}_{match.group('number')}.{self.archive_format}"
+        return os.path.join(self.archive_dir, date[:4], date[4:6], date[6:], phone_id, file_name)
+
+    # wav files old enough to be finished turns
+    def finished_wavs(self):
+        now = time.time()
+        paths = []
+        for path in glob(os.path.join(self.audio_dir, "*.wav")):
+            try:
+                if now - os.path.getmtime(path) >= self.min_age:
+                    paths.append(path)
+            except OSError:
+                continue
+        return sorted(paths)
+
+    def probe_duration(self, path):
+        result = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path],
+                                capture_output=True, text=True, timeout=60, check=True)
+        return float(result.stdout.strip())
+
+    # transcode one wav; returns True when it was archived
+    def archive_file(self, wav_path):
+        match = AUDIO_FILE_NAME.match(os.path.basename(wav_path))
+        if not match:
+            return False
+
+        started = time.perf_counter()
+        session_id, number = match.group("session_id"), int(match.group("number"))
+        target = self.archive_path(match)
+        tmp_target = f"{target}.tmp.{self.archive_format}"
+        try:
+            with self.pool.connection() as connection, connection.cursor() as cursor:
+                has_row = cursor.execute(CONTEXT_ROW_EXISTS, (session_id, number))
+            if not has_row and time.time() - os.path.getmtime(wav_path) < self.orphan_age:
+                # the context row is not written yet (e.g. still in the context journal) : retry later
+                return False
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with wave.open(wav_path, "rb") as wav_file:
+                duration = wav_file.getnframes() / wav_file.getframerate()
+
+            subprocess.run(["ffmpeg", "-nostdin", "-y", "-v", "error", "-i", wav_path, *ARCHIVE_FORMATS[self.archive_format], tmp_target],
+                           capture_output=True, timeout=300, check=True)
+
+            # playback check : the archived file has to decode to (about) the same length
+            archived_duration = self.probe_duration(tmp_target)
+            if abs(archived_duration - duration) > 0.1:
+                raise ValueError(f"duration mismatch {archived_duration:.2f}s != {duration:.2f}s")
+            os.replace(tmp_target, target)
+
+            if has_row:
+                with self.pool.connection() as connection, connection.cursor() as cursor:
+                    cursor.execute(UPDATE_AUDIO_FILE_DIR, (target, session_id, number))
+                    connection.commit()
+
+            bytes_in, bytes_out = os.path.getsize(wav_path), os.path.getsize(target)
+            os.remove(wav_path)
+
+        except (OSError, ValueError, subprocess.SubprocessError, wave.Error, pymysql.Error) as error:
+            print(f"Audio archive failed for {wav_path}: {error}")
+            if os.path.exists(tmp_target):
+                os.remove(tmp_target)
+            with self.lock:
+                self.failures += 1
+            return False
+
+        with self.lock:
+            self.files += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.audio_seconds += duration
+            self.busy_seconds += time.perf_counter() - started
+        return True
+
+    # archive every finished wav, returns the number of archived files
+    def archive_pending(self):
+        if not self.enabled:
+            return 0
+        paths = self.finished_wavs()
+        if not paths:
+            return 0
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="elf-archive") as executor:
+            archived = sum(executor.map(self.archive_file, paths))
+        print(f"Audio archive : {archived}/{len(paths)} files archived.")
+        return archived
+
+    def stats(self):
+        with self.lock:
+            return {
+                "format": self.archive_format,
+                "enabled": self.enabled,
+                "files": self.files,
+                "failures": self.failures,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "compression_ratio": (self.bytes_in / self.bytes_out) if self.bytes_out else 0.0,
+                # seconds of speech archived per second of (per worker) transcoding time
+                "throughput_x_realtime": (self.audio_seconds / self.busy_seconds) if self.busy_seconds else 0.0,
+            }
+
+
+def main():
+    from db_pool import ConnectionPool
+    from migrate import db_config
+
+    parser = argparse.ArgumentParser(description="Archive finished user audio files")
+    parser.add_argument("--audio-dir", default="./useraudiofile")
+    parser.add_argument("--format", choices=sorted(ARCHIVE_FORMATS), default=os.environ.get('ELF_AUDIO_ARCHIVE_FORMAT', 'opus'))
+    parser.add_argument("--min-age", type=int, default=1800, help="seconds since the last write of a wav")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    args = parser.parse_args()
+
+    pool = ConnectionPool(db_config, max_size=args.workers)
+    archiver = AudioArchiver(pool, args.audio_dir, args.format, min_age=args.min_age, workers=args.workers)
+    started = time.perf_counter()
+    archiver.archive_pending()
+    pool.close()
+
+    stats = archiver.stats()
+    elapsed = time.perf_counter() - started
+    print(f"{stats['files']} files in {elapsed:.1f}s, {stats['failures']} failures, "
+          f"{stats['bytes_in'] / 1e6:.1f}MB -> {stats['bytes_out'] / 1e6:.1f}MB (x{stats['compression_ratio']:.1f}), "
+          f"{stats['bytes_in'] / 1e6 / elapsed if elapsed else 0:.1f}MB/s")
+
+
+if __name__ == "__main__":
+    main()
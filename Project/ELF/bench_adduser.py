@@ -0,0 +1,109 @@
+
+# Load benchmark for /adduser of the medical form server (dbinsert_web.py)
+#
+#   python bench_adduser.py --url http://127.0.0.1:8846 --requests 500 --concurrency 50
+#
+# Sends concurrent form submissions and reports throughput and latency percentiles.
+# While the load runs, GET /metrics is probed in a loop: its latency shows whether database work
+# is blocking the event loop (it should stay in the low milliseconds even while /adduser is busy).
+# Every request creates a real user, so run it against a test database.
+
+
+import argparse
+import asyncio
+import time
+import uuid
+
+import httpx
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarize(name, latencies):
+    print(f"{name}: n={len(latencies)} "
+          f"p50={percentile(latencies, 50) * 1000:.1f}ms "
+          f"p95={percentile(latencies, 95) * 1000:.1f}ms "
+          f"p99={percentile(latencies, 99) * 1000:.1f}ms "
+          f"max={max(latencies, default=0) * 1000:.1f}ms")
+
+
+def make_form(run_id, n):
+    return {
+        "userName": f"bench_{run_id}_{n}",
+        "userId": f"bench{n}",
+        "userSex": "female" if n % 2 else "male",
+        "userAge": str(60 + n % 30),
+        "diseases": [["diabetes"], ["hypertension"]],
+        "casualAlarm": [["09:00"], ["19:00"]],
+        "healthIssues": "none",
+        "medication": [{"name": "metformin", "time": ["08:00", "20:00"]}],
+        "injection": []
+    }
+
+
+async def submit_forms(client, url, run_id, numbers, latencies, failures):
+    for n in numbers:
+        started = time.perf_counter()
+        try:
+            response = await client.post(f"{url}/adduser", json=make_form(run_id, n))
+            if response.status_code != 200:
+                failures.append(f"{response.status_code} {response.text[:200]}")
+        except httpx.HTTPError as e:
+            failures.append(repr(e))
+        latencies.append(time.perf_counter() - started)
+
+
+async def probe(client, url, latencies, stop, interval=0.05):
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            await client.get(f"{url}/metrics")
+            latencies.append(time.perf_counter() - started)
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(interval)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark /adduser under concurrent submissions")
+    parser.add_argument("--url", default="http://127.0.0.1:8846")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    run_id = uuid.uuid4().hex[:8]
+    latencies, probe_latencies, failures = [], [], []
+    stop = asyncio.Event()
+
+    limits = httpx.Limits(max_connections=args.concurrency + 1)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        probe_task = asyncio.create_task(probe(client, args.url, probe_latencies, stop))
+
+        started = time.perf_counter()
+        await asyncio.gather(*[
+            submit_forms(client, args.url, run_id, range(worker, args.requests, args.concurrency), latencies, failures)
+            for worker in range(args.concurrency)
+        ])
+        elapsed = time.perf_counter() - started
+
+        stop.set()
+        await probe_task
+        metrics = (await client.get(f"{args.url}/metrics")).json()
+
+    print(f"run {run_id}: {args.requests} requests, concurrency {args.concurrency}, {elapsed:.2f}s")
+    print(f"throughput: {args.requests / elapsed:.1f} req/s, failures: {len(failures)}")
+    summarize("/adduser", latencies)
+    summarize("/metrics during load", probe_latencies)
+    print(f"db_pool: {metrics.get('db_pool')}")
+    for failure in failures[:5]:
+        print(f"  failure: {failure}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
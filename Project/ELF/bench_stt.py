@@ -0,0 +1,115 @@
+
+# Latency / accuracy benchmark of the STT backends on recorded user turns (./useraudiofile/*.wav)
+#
+#   python bench_stt.py --backends openai local --reference openai
+#   python bench_stt.py --backends local --references refs.tsv --limit 200
+#
+# Accuracy is the character error rate (CER, suited to Korean) against reference transcripts, taken from
+# a TSV file (<wav file name>\t<text>) or from the output of another backend (e.g. whisper-1 in production).
+
+
+from glob import glob
+import argparse
+import os
+import time
+import wave
+
+from dotenv import load_dotenv, find_dotenv
+from openai import OpenAI
+
+from stt import create_stt_backend, pcm_duration, PCM_SAMPLE_RATE
+
+
+def read_pcm(path):
+    with wave.open(path, "rb") as wav_file:
+        if wav_file.getframerate() != PCM_SAMPLE_RATE or wav_file.getnchannels() != 1 or wav_file.getsampwidth() != 2:
+            return None
+        return wav_file.readframes(wav_file.getnframes())
+
+
+def normalize(text):
+    return "".join(ch for ch in text.lower() if ch.isalnum())
+
+
+# Levenshtein distance over characters
+def edit_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, start=1):
+        current = [i]
+        for j, cb in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))] if values else 0.0
+
+
+def read_references(path):
+    references = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            name, _, text = line.rstrip("\n").partition("\t")
+            references[os.path.basename(name)] = text
+    return references
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark STT backends on recorded user audio")
+    parser.add_argument("--audio-dir", default="./useraudiofile")
+    parser.add_argument("--backends", nargs="+", default=["openai", "local"])
+    parser.add_argument("--reference", help="backend whose transcripts are the reference")
+    parser.add_argument("--references", help="TSV file of reference transcripts")
+    parser.add_argument("--local-model", default=os.environ.get('ELF_STT_LOCAL_MODEL', 'small'))
+    parser.add_argument("--language", default=os.environ.get('ELF_STT_LANGUAGE') or None)
+    parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args()
+
+    _ = load_dotenv(find_dotenv())
+    openai_client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
+
+    files = sorted(glob(os.path.join(args.audio_dir, "*.wav")))[:args.limit]
+    samples = [(path, pcm) for path, pcm in ((path, read_pcm(path)) for path in files) if pcm]
+    print(f"{len(samples)} utterances, {sum(pcm_duration(pcm) for _, pcm in samples):.0f}s of speech")
+
+    names = list(dict.fromkeys(args.backends + ([args.reference] if args.reference else [])))
+    transcripts = {}
+    for name in names:
+        backend = create_stt_backend(name, openai_client, local_model=args.local_model, local_workers=1, language=args.language)
+        started = time.perf_counter()
+        backend.load()
+        load_seconds = time.perf_counter() - started
+
+        latencies, transcripts[name] = [], {}
+        for path, pcm in samples:
+            started = time.perf_counter()
+            try:
+                transcripts[name][os.path.basename(path)] = backend.transcribe(pcm)
+            except Exception as e:
+                print(f"{name} failed on {path}: {e}")
+                continue
+            latencies.append(time.perf_counter() - started)
+
+        stats = backend.stats()
+        print(f"{name}: load={load_seconds:.1f}s p50={percentile(latencies, 50) * 1000:.0f}ms "
+              f"p95={percentile(latencies, 95) * 1000:.0f}ms rtf={stats['real_time_factor']:.2f} errors={stats['errors']}")
+
+    references = read_references(args.references) if args.references else transcripts.get(args.reference)
+    if not references:
+        return
+
+    for name in args.backends:
+        if name == args.reference:
+            continue
+        errors = chars = 0
+        for file_name, reference in references.items():
+            if file_name in transcripts[name]:
+                errors += edit_distance(normalize(transcripts[name][file_name]), normalize(reference))
+                chars += len(normalize(reference))
+        print(f"{name}: CER={errors / chars:.3f} over {chars} reference characters" if chars else f"{name}: no references matched")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+
+# Query-plan regression check for the production queries in queries.py
+#
+#   python check_query_plans.py
+#
+# Creates a scratch database on the local MySQL (ELF_PLAN_DB_NAME, dropped and recreated on every run),
+# applies ./migrations, seeds it with a realistic spread of users, sessions and summaries,
+# then runs EXPLAIN on every hot query. Exits with status 1 if any query reads a table with a full scan
+# (type ALL) or sorts with "Using filesort", so a dropped index or a rewritten query is caught before deploy.
+
+
+from datetime import datetime, timedelta
+import os
+import sys
+
+import pymysql
+import pymysql.cursors
+
+from migrate import apply_migrations
+import queries
+
+
+plan_db_name = os.environ.get('ELF_PLAN_DB_NAME', 'seniorcare_plan_check')
+server_config = {
+    'host': os.environ.get('ELF_DB_HOST', '127.0.0.1'),
+    'user': os.environ.get('ELF_DB_USER', 'root'),
+    'password': os.environ.get('ELF_DB_PASSWORD', '')
+}
+
+SEED_USERS = int(os.environ.get('ELF_PLAN_SEED_USERS', '300'))
+SEED_SESSIONS = 8           # sessions (and summaries) per user
+SEED_TURNS = 12             # context rows per session
+
+SAMPLE_PHONE_ID = "phone_0007"
+SAMPLE_USERNAME = "user_0007"
+SAMPLE_SESSION_ID = "20240101090000_phone_0007"
+
+# (name, query, sample parameters) for every query checked
+PLAN_CHECKS = [
+    ("USER_PROFILE", queries.USER_PROFILE, (SAMPLE_PHONE_ID,)),
+    ("LATEST_NEXT_FIRST_QUESTION", queries.LATEST_NEXT_FIRST_QUESTION, (SAMPLE_PHONE_ID,)),
+    ("SESSION_CONVERSATION", queries.SESSION_CONVERSATION, (SAMPLE_SESSION_ID,)),
+    ("LATEST_SESSION_CONVERSATION", queries.LATEST_SESSION_CONVERSATION, (SAMPLE_PHONE_ID,)),
+    ("RECENT_HISTORY", queries.RECENT_HISTORY, (SAMPLE_PHONE_ID,)),
+    ("USERNAME_EXISTS", queries.USERNAME_EXISTS, (SAMPLE_USERNAME,)),
+] + [
+    (f"PHONE_ID_UPDATES[{table}]", query, ("new_phone", SAMPLE_USERNAME))
+    for table, query in queries.PHONE_ID_UPDATES.items()
+]
+# queries.ALARM_PHONE_IDS lists every alarm row on purpose and is not checked
+
+
+def seed(connection):
+    base = datetime(2024, 1, 1, 9, 0, 0)
+    users, alarms, healthinfos, contexts, summaries, states = [], [], [], [], [], []
+
+    for n in range(SEED_USERS):
+        phone_id, username = f"phone_{n:04d}", f"user_{n:04d}"
+        users.append((phone_id, username, f"id_{n:04d}", "female" if n % 2 else "male", 60 + n % 30))
+        alarms.append((phone_id, username, '["09:00", "21:00"]', '{"medication": ["08:00"]}'))
+        healthinfos.append((phone_id, username, '["diabetes"]', '["metformin"]', '[]', "none"))
+
+        for s in range(SEED_SESSIONS):
+            started = base + timedelta(days=s, minutes=n)
+            session_id = f"{started.strftime('%Y%m%d%H%M%S')}_{phone_id}"
+            for t in range(SEED_TURNS):
+                contexts.append((session_id, t, started + timedelta(seconds=20 * t), phone_id, username,
+                                 "casual_greeting", "gpt-4o", "user" if t % 2 else "assistant", f"turn {t}", None))
+            summaries.append((session_id, started + timedelta(minutes=10), phone_id, username,
+                              "casual_greeting", "gpt-4o", f"summary {s}", f"question {s}"))
+        latest = summaries[-1]
+        states.append((phone_id, username, latest[0], latest[4], latest[6], latest[7], latest[1]))
+
+    with connection.cursor() as cursor:
+        cursor.executemany("INSERT INTO user (phone_id, username, userid, usersex, userage) VALUES (%s, %s, %s, %s, %s)", users)
+        cursor.executemany("INSERT INTO alarm (phone_id, username, casual_alarm_time, med_alarm_time) VALUES (%s, %s, %s, %s)", alarms)
+        cursor.executemany("INSERT INTO healthinfo (phone_id, username, disease, medication, injection, healthissue) VALUES (%s, %s, %s, %s, %s, %s)", healthinfos)
+        cursor.executemany(queries.INSERT_CONTEXT, contexts)
+        cursor.executemany(queries.INSERT_SUMMARIZATION, summaries)
+        cursor.executemany(queries.UPSERT_SUMMARY_STATE, states)
+        cursor.executemany(queries.UPSERT_CONTEXT_STATE, [(row[3], row[4], row[0], row[2]) for row in contexts[SEED_TURNS - 1::SEED_TURNS]])
+        connection.commit()
+
+        # fresh index statistics so the optimizer plans as it would on the production data
+        cursor.execute("ANALYZE TABLE user, alarm, healthinfo, context, summarization, user_state")
+        cursor.fetchall()
+
+
+# problems found in one EXPLAIN output
+def plan_problems(rows):
+    problems = []
+    for row in rows:
+        table = row.get("table") or ""
+        # the outer ORDER BY of RECENT_HISTORY sorts its own 20-row derived table, which is expected
+        if table.startswith("<derived"):
+            continue
+        extra = row.get("Extra") or ""
+        if row.get("type") == "ALL":
+            problems.append(f"full scan on {table}")
+        if "Using filesort" in extra:
+            problems.append(f"filesort on {table}")
+    return problems
+
+
+def main():
+    try:
+        connection = pymysql.connect(**server_config)
+    except pymysql.Error as error:
+        print(f"Error while connecting to MySQL: {error}")
+        return 1
+
+    failed = 0
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP DATABASE IF EXISTS `{plan_db_name}`")
+            cursor.execute(f"CREATE DATABASE `{plan_db_name}` DEFAULT CHARSET utf8mb4")
+        connection.select_db(plan_db_name)
+
+        apply_migrations(connection)
+        seed(connection)
+
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            for name, query, params in PLAN_CHECKS:
+                cursor.execute("EXPLAIN " + query, params)
+                rows = cursor.fetchall()
+                problems = plan_problems(rows)
+
+                print(f"{'FAIL' if problems else 'ok  '}  {name}")
+                for row in rows:
+                    print(f"        {row.get('select_type')} {row.get('table')} type={row.get('type')} key={row.get('key')} extra={row.get('Extra')}")
+                for problem in problems:
+                    print(f"        -> {problem}")
+                failed += bool(problems)
+
+    except pymysql.Error as error:
+        print(f"Error while checking query plans: {error}")
+        return 1
+    finally:
+        connection.close()
+
+    print(f"\n{len(PLAN_CHECKS) - failed}/{len(PLAN_CHECKS)} query plans ok")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+
+# Shared MySQL connection pool used by the conversation server and the medical form server
+
+
+from contextlib import contextmanager
+import threading
+import time
+
+import pymysql
+
+
+class PoolTimeoutError(pymysql.err.OperationalError):
+    """Raised when no pooled connection became free within the acquire timeout."""
+
+
+# Bounded pool of pymysql connections.
+# - at most max_size connections exist at any time (idle + in use)
+# - idle connections are health checked with ping() before being handed out
+# - connections older than max_lifetime seconds are closed and replaced
+# - every acquire is timed so that pool pressure can be seen in stats()
+class ConnectionPool:
+    def __init__(self, db_config, max_size=10, max_lifetime=1800, acquire_timeout=5.0, ping_interval=30):
+        self.db_config = db_config
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.acquire_timeout = acquire_timeout
+        self.ping_interval = ping_interval
+
+        self._idle = []                 # [(connection, created_at, last_used_at)]
+        self._created_at = {}           # id(connection) -> created_at
+        self._size = 0
+        self._cond = threading.Condition()
+
+        self._acquires = 0
+        self._acquire_wait_total = 0.0
+        self._acquire_wait_max = 0.0
+        self._timeouts = 0
+        self._opened = 0
+        self._recycled = 0
+        self._broken = 0
+
+    def _open(self):
+        connection = pymysql.connect(**self.db_config)
+        self._created_at[id(connection)] = time.monotonic()
+        self._opened += 1
+        return connection
+
+    def _discard(self, connection):
+        self._created_at.pop(id(connection), None)
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    # check an idle connection before reuse; returns False if it has to be replaced
+    def _is_usable(self, connection, created_at, last_used_at):
+        now = time.monotonic()
+        if now - created_at > self.max_lifetime:
+            self._recycled += 1
+            return False
+        if now - last_used_at > self.ping_interval:
+            try:
+                connection.ping(reconnect=False)
+            except pymysql.Error:
+                self._broken += 1
+                return False
+        return True
+
+    def acquire(self):
+        started = time.monotonic()
+        deadline = started + self.acquire_timeout
+
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeoutError(f"no MySQL connection available within {self.acquire_timeout}s (max_size={self.max_size})")
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    connection, created_at, last_used_at = self._idle.pop()
+                else:
+                    connection, created_at, last_used_at = None, None, None
+                    self._size += 1
+
+            if connection is not None:
+                if self._is_usable(connection, created_at, last_used_at):
+                    break
+                self._discard(connection)
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                continue
+
+            try:
+                connection = self._open()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            break
+
+        waited = time.monotonic() - started
+        with self._cond:
+            self._acquires += 1
+            self._acquire_wait_total += waited
+            self._acquire_wait_max = max(self._acquire_wait_max, waited)
+        return connection
+
+    # return a connection to the pool; broken connections are closed instead
+    def release(self, connection, broken=False):
+        if not broken:
+            try:
+                # end any implicit transaction left open by a SELECT so the next user sees fresh data
+                connection.rollback()
+            except pymysql.Error:
+                broken = True
+
+        with self._cond:
+            if broken:
+                self._broken += 1
+                self._size -= 1
+            else:
+                self._idle.append((connection, self._created_at.get(id(connection), time.monotonic()), time.monotonic()))
+            self._cond.notify()
+
+        if broken:
+            self._discard(connection)
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        broken = False
+        try:
+            yield connection
+        except pymysql.err.OperationalError:
+            broken = True
+            raise
+        except BaseException:
+            try:
+                connection.rollback()
+            except pymysql.Error:
+                broken = True
+            raise
+        finally:
+            self.release(connection, broken)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "max_size": self.max_size,
+                "acquires": self._acquires,
+                "acquire_wait_avg_ms": (self._acquire_wait_total / self._acquires * 1000) if self._acquires else 0.0,
+                "acquire_wait_max_ms": self._acquire_wait_max * 1000,
+                "timeouts": self._timeouts,
+                "opened": self._opened,
+                "recycled": self._recycled,
+                "broken": self._broken,
+            }
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for connection, *_ in idle:
+            self._discard(connection)
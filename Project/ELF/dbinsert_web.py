@@ -6,13 +6,23 @@ from datetime import datetime
 from pytz import timezone
 from typing import List
 from fastapi import FastAPI, Request, HTTPException, File, UploadFile, Form
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, FileResponse, Response
 from fastapi.templating import Jinja2Templates
-from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+from concurrent.futures import ThreadPoolExecutor
+from pydantic import BaseModel, ValidationError
+from db_pool import ConnectionPool
+import queries
 import pymysql
+import asyncio
+import csv
+import functools
+import hashlib
+import io
 import json
-import shutil
+import tempfile
 import os
+import urllib.request
 
 db_config = {
     'host': '127.0.0.1',
@@ -21,85 +31,121 @@ db_config = {
     'database': 'seniorcare'
 }
 
-# 데이터베이스에 데이터 삽입 함수
-def insert_healthinfo(phone_id, username, userid, usersex, userage, diseases, medication, injection, healthissues, casual_alarm_time):
-    
-    try :
-        
-        connection = pymysql.connect(**db_config)
-        cursor = connection.cursor()
-        
-        insert_user_query = """
-        INSERT INTO user (phone_id, username, userid, usersex, userage)
-        VALUES (%s, %s, %s, %s, %s)"""
-        values = (phone_id, username, userid, usersex, userage)
-        cursor.execute(insert_user_query, values)
-        connection.commit()
-        
-        insert_healthinfo_query = """
-        INSERT INTO healthinfo (phone_id, username, disease, medication, injection, healthissue)
-        VALUES (%s, %s, %s, %s, %s, %s)
-        """
-        values = (phone_id, username, json.dumps(diseases), json.dumps(medication), json.dumps(injection), healthissues)
-        cursor.execute(insert_healthinfo_query, values)
-        connection.commit()
-        
-        
-        combined_health = {}
+# shared, bounded MySQL connection pool (same pool implementation as the conversation server)
+db_pool = ConnectionPool(db_config, max_size=int(os.environ.get('ELF_DB_POOL_SIZE', '10')))
 
-        if medication is not None or not "없음":
-            for med in medication:
-                combined_health.update(med)
-    
-                
-        if injection is not None or not "없음":
-            for inj in injection:
-                combined_health.update(inj)
+# blocking pymysql work runs here, never on the event loop, so a slow commit cannot stall the other routes.
+# One thread per pooled connection: extra requests queue here instead of timing out in db_pool.acquire().
+db_executor = ThreadPoolExecutor(max_workers=db_pool.max_size, thread_name_prefix='elf-db')
 
-        if combined_health == {}:
-            combined_health == None
-        
-        med_alarm_time = [{"health": combined_health}] #
-        casual_alarm_time = [{"casual": casual_alarm_time}]
-
-        insert_alarm_query = """
-        INSERT INTO alarm (phone_id, username, casual_alarm_time, med_alarm_time)
-        VALUES (%s, %s, %s, %s)
-        """
-        values = (phone_id, username, json.dumps(casual_alarm_time),json.dumps(med_alarm_time, default=str, ensure_ascii = False))
-        
-        cursor.execute(insert_alarm_query, values)
-        connection.commit()
-        
-        current_insert_time = datetime.now(timezone('Asia/Seoul')).strftime('%Y-%m-%d %H:%M:%S')
-        initial_greeting = "안녕하세요. 제 이름은 엘프에요. 만나서 반가워요." # "Hello, my name is elf. Nice to meet you!"
-        
-        conversation_start = "casual_greeting"
-        insert_context_query = """INSERT INTO context
-        (session_id, unique_number, created_at, phone_id, username, conversation_start, model, role, content)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)"""
-        values = (f"{datetime.now(timezone('Asia/Seoul')).strftime('%Y%m%d%H%M%S')}_{phone_id}", 0, current_insert_time, phone_id, username, conversation_start, "scripted", "initialization", "안녕!")
-        
-        cursor.execute(insert_context_query,values)
-        connection.commit()
-        
-        insert_summarization_query = """ 
-        INSERT INTO summarization (session_id, summ_created_at, phone_id, username, conversation_start, summary_model, summary, next_first_question)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"""
-        values = (f"{datetime.now(timezone('Asia/Seoul')).strftime('%Y%m%d%H%M%S')}_{phone_id}", current_insert_time, phone_id, username, 'casual_greeting', 'sum_initialization', 'sum_initialization', initial_greeting)
-        
-        cursor.execute(insert_summarization_query, values)
+# run a blocking database function on db_executor and await its result
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args, **kwargs))
+
+# conversation server (test_server) which caches user profiles
+elf_server_url = os.environ.get('ELF_SERVER_URL', 'http://127.0.0.1:8845')
+
+# POST a change notification to an internal endpoint of the conversation server
+def notify_elf_server(path, payload):
+    request = urllib.request.Request(
+        f"{elf_server_url}{path}",
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST"
+    )
+    urllib.request.urlopen(request, timeout=2).close()
+
+# tell the conversation server to drop its cached profile of a user (best effort)
+def notify_profile_changed(phone_id, username):
+    try:
+        notify_elf_server("/internal/profile_invalidate", {"phone_id": phone_id, "username": username})
+    except Exception as e:
+        print(f"Profile invalidation failed: {e}")
+
+# tell the conversation server that a new build is published, so it pushes the version to the phones (best effort,
+# the server also notices the new version.txt on its own within a few seconds)
+def notify_version_published(version):
+    try:
+        notify_elf_server("/internal/version_published", {"version": version})
+    except Exception as e:
+        print(f"Version publish notification failed: {e}")
+
+# one INSERT per table, executed with executemany so that a batch of users costs one round-trip per table
+insert_queries = {
+    "user": """
+            INSERT INTO user (phone_id, username, userid, usersex, userage)
+            VALUES (%s, %s, %s, %s, %s)""",
+    "healthinfo": """
+            INSERT INTO healthinfo (phone_id, username, disease, medication, injection, healthissue)
+            VALUES (%s, %s, %s, %s, %s, %s)""",
+    "alarm": """
+            INSERT INTO alarm (phone_id, username, casual_alarm_time, med_alarm_time)
+            VALUES (%s, %s, %s, %s)""",
+    "context": """INSERT INTO context
+            (session_id, unique_number, created_at, phone_id, username, conversation_start, model, role, content)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+    "summarization": """
+            INSERT INTO summarization (session_id, summ_created_at, phone_id, username, conversation_start, summary_model, summary, next_first_question)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
+    # latest-session pointer of the new user (see migrations/0002_user_state.sql)
+    "user_state_summary": queries.UPSERT_SUMMARY_STATE,
+    "user_state_context": queries.UPSERT_CONTEXT_STATE
+}
+
+# rows of every table for one new user
+def build_user_rows(phone_id, username, userid, usersex, userage, diseases, medication, injection, healthissues, casual_alarm_time):
+    now = datetime.now(timezone('Asia/Seoul'))
+    current_insert_time = now.strftime('%Y-%m-%d %H:%M:%S')
+    session_id = f"{now.strftime('%Y%m%d%H%M%S')}_{phone_id}"
+    initial_greeting = "안녕하세요. 제 이름은 엘프에요. 만나서 반가워요." # "Hello, my name is elf. Nice to meet you!"
+    conversation_start = "casual_greeting"
+
+    combined_health = {}
+    for med in medication or []:
+        combined_health.update(med)
+    for inj in injection or []:
+        combined_health.update(inj)
+
+    med_alarm_time = [{"health": combined_health}] #
+    casual_alarm_time = [{"casual": casual_alarm_time}]
+
+    return {
+        "user": (phone_id, username, userid, usersex, userage),
+        "healthinfo": (phone_id, username, json.dumps(diseases), json.dumps(medication), json.dumps(injection), healthissues),
+        "alarm": (phone_id, username, json.dumps(casual_alarm_time), json.dumps(med_alarm_time, default=str, ensure_ascii = False)),
+        "context": (session_id, 0, current_insert_time, phone_id, username, conversation_start, "scripted", "initialization", "안녕!"),
+        "summarization": (session_id, current_insert_time, phone_id, username, conversation_start, 'sum_initialization', 'sum_initialization', initial_greeting),
+        "user_state_summary": (phone_id, username, session_id, conversation_start, 'sum_initialization', initial_greeting, current_insert_time),
+        "user_state_context": (phone_id, username, session_id, current_insert_time)
+    }
+
+# insert the rows of one or more users, all tables in a single transaction
+def insert_user_rows(users_rows):
+    with db_pool.connection() as connection, connection.cursor() as cursor:
+        for table, query in insert_queries.items():
+            cursor.executemany(query, [rows[table] for rows in users_rows])
         connection.commit()
-        
+
+# 데이터베이스에 데이터 삽입 함수
+def insert_healthinfo(phone_id, username, userid, usersex, userage, diseases, medication, injection, healthissues, casual_alarm_time):
     
+    try :
+        insert_user_rows([build_user_rows(phone_id, username, userid, usersex, userage, diseases, medication, injection, healthissues, casual_alarm_time)])
 
     except pymysql.Error as error:
         print(f"Error while connecting to MySQL: {error}")
         raise HTTPException(status_code=500, detail=str(error))
 
-    finally:
-        cursor.close()
-        connection.close()
+# usernames that are already registered (phone_id binding in the conversation server is done by username)
+def find_existing_usernames(usernames):
+    if not usernames:
+        return set()
+    with db_pool.connection() as connection, connection.cursor() as cursor:
+        placeholders = ", ".join(["%s"] * len(usernames))
+        cursor.execute(f"SELECT username FROM user WHERE username IN ({placeholders})", list(usernames))
+        return {row[0] for row in cursor.fetchall()}
+
 
 app = FastAPI()
 
@@ -127,57 +173,160 @@ class FormData(BaseModel):
 templates = Jinja2Templates(directory='./templates')
 upload_dir = "/var/www/html/downloads/seniorcare/"
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+VERSION_FILE_NAME = "version.txt"
+
+# only plain file names inside upload_dir (no paths, no hidden files, never the version file itself)
+def safe_package_name(filename):
+    name = os.path.basename((filename or "").replace("\\", "/"))
+    if not name or name.startswith(".") or name == VERSION_FILE_NAME or name.endswith(".sha256"):
+        raise HTTPException(status_code=400, detail=f"invalid file name: {filename!r}")
+    return name
+
+# write a file next to its final path and rename it into place, so readers only ever see complete files
+def atomic_write(path, chunks):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".upload-")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            for chunk in chunks:
+                tmp.write(chunk)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+# stream the uploaded package to disk in chunks, returns (sha256 hex, size)
+def store_package(src, file_path, expected_sha256=None):
+    digest = hashlib.sha256()
+    size = 0
+
+    def chunks():
+        nonlocal size
+        while True:
+            chunk = src.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+            yield chunk
+        if expected_sha256 and digest.hexdigest() != expected_sha256.lower():
+            raise ValueError(f"sha256 mismatch: expected {expected_sha256}, got {digest.hexdigest()}")
+
+    atomic_write(file_path, chunks())
+
+    # the hash is only valid for this exact file (size + mtime), so a download racing the next upload
+    # can never pair the new bytes with the old ETag
+    stat_result = os.stat(file_path)
+    atomic_write(file_path + ".sha256", [f"{digest.hexdigest()} {stat_result.st_size} {stat_result.st_mtime_ns}".encode()])
+    return digest.hexdigest(), size
+
+# sha256 of a stored package, or None if unknown / stale
+def read_package_sha256(file_path, stat_result):
+    try:
+        with open(file_path + ".sha256") as sha_file:
+            digest, size, mtime_ns = sha_file.read().split()
+    except (OSError, ValueError):
+        return None
+    if int(size) != stat_result.st_size or int(mtime_ns) != stat_result.st_mtime_ns:
+        return None
+    return digest
+
+# Publish a new app build.
+# The package is streamed to a temp file, hashed, renamed into place and only then is version.txt
+# replaced, so the version command never advertises a build that is not completely on disk.
 @app.post("/upload_func")
-async def upload_file(file: UploadFile = File(...), version: str = Form(...)):
+async def upload_file(file: UploadFile = File(...), version: str = Form(...), sha256: str = Form(None)):
     os.makedirs(upload_dir, exist_ok=True)
     
-    file_path = os.path.join(upload_dir, file.filename)
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
+    filename = safe_package_name(file.filename)
+    file_path = os.path.join(upload_dir, filename)
+    try:
+        digest, size = await run_in_threadpool(store_package, file.file, file_path, sha256)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    version_file_path = os.path.join(upload_dir, "version.txt")
-    with open(version_file_path, "w") as version_file:
-        version_file.write(version)
+    version_file_path = os.path.join(upload_dir, VERSION_FILE_NAME)
+    await run_in_threadpool(atomic_write, version_file_path, [version.encode()])
+    await run_in_threadpool(notify_version_published, version)
         
-    return {"filename": file.filename, "version":version}
+    return {"filename": filename, "version": version, "sha256": digest, "size": size}
+
+# Download a published package.
+# FileResponse answers Range / If-Range requests (resumable downloads on weak links) and uses
+# the server's sendfile (http.response.pathsend) when available. The ETag is the content hash,
+# so a resumed download never mixes bytes of two different builds.
+@app.get("/download/{filename}")
+async def download_file(filename: str, request: Request):
+    file_path = os.path.join(upload_dir, safe_package_name(filename))
+    try:
+        stat_result = os.stat(file_path)
+    except OSError:
+        raise HTTPException(status_code=404, detail="file not found")
+
+    headers = {"Cache-Control": "no-cache"}
+    digest = await run_in_threadpool(read_package_sha256, file_path, stat_result)
+    if digest:
+        headers["ETag"] = f'"{digest}"'
+    # without a hash (uploaded before hashes were stored) FileResponse falls back to an mtime/size ETag
+
+    if digest and request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+
+    return FileResponse(file_path, headers=headers, stat_result=stat_result, filename=os.path.basename(file_path))
 
 @app.get("/upload", response_class=HTMLResponse)
 async def upload_form(request: Request):
     return templates.TemplateResponse("upload.html", {"request": request})
 
+@app.get("/metrics")
+async def get_metrics():
+    return {"db_pool": db_pool.stats()}
+
 @app.get("/", response_class=HTMLResponse)
 async def read_index(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
+# FormData -> values stored in the database
+def transform_form_data(data: FormData):
+    trans_data = {
+        "userName": data.userName,
+        "userId": data.userId,
+        "userSex": data.userSex,
+        "userAge": int(data.userAge),
+        "diseases": [disease for sublist in data.diseases for disease in sublist if disease],
+        "casualAlarm": [alarm for sublist in data.casualAlarm for alarm in sublist if alarm],
+        "healthIssues": data.healthIssues if data.healthIssues else None,
+        "medication": [{med.name: [time for time in med.time if time]} for med in data.medication],
+        "injection": [{inj.name: [time for time in inj.time if time]} for inj in data.injection]
+    }
+
+    if not trans_data["diseases"]:
+        trans_data["diseases"] = None
+    if not trans_data["casualAlarm"]:
+        trans_data["casualAlarm"] = None
+    if not trans_data["medication"]:
+        trans_data["medication"] = None
+    if not trans_data["injection"]:
+        trans_data["injection"] = None
+
+    return trans_data
+
+def new_phone_id(username):
+    return f"{username}_{datetime.now(timezone('Asia/Seoul')).strftime('%Y%m%d%H%M%S')}"
+
 @app.post("/adduser")
 async def addUser(data: FormData):
     try:
-        trans_data = {
-            "userName": data.userName,
-            "userId": data.userId,
-            "userSex": data.userSex,
-            "userAge": int(data.userAge),
-            "diseases": [disease for sublist in data.diseases for disease in sublist if disease],
-            "casualAlarm": [alarm for sublist in data.casualAlarm for alarm in sublist if alarm],
-            "healthIssues": data.healthIssues if data.healthIssues else None,
-            "medication": [{med.name: [time for time in med.time if time]} for med in data.medication],
-            "injection": [{inj.name: [time for time in inj.time if time]} for inj in data.injection]
-        }
-
-        if not trans_data["diseases"]:
-            trans_data["diseases"] = None
-        if not trans_data["casualAlarm"]:
-            trans_data["casualAlarm"] = None
-        if not trans_data["medication"]:
-            trans_data["medication"] = None
-        if not trans_data["injection"]:
-            trans_data["injection"] = None
+        trans_data = transform_form_data(data)
 
         print(trans_data)
         
-        phone_id = f"{trans_data['userName']}_{datetime.now(timezone('Asia/Seoul')).strftime('%Y%m%d%H%M%S')}"
-        insert_healthinfo(phone_id, trans_data['userName'], trans_data['userId'], trans_data['userSex'], trans_data['userAge'], trans_data['diseases'], trans_data['medication'], trans_data['injection'], trans_data['healthIssues'], trans_data['casualAlarm'])
+        phone_id = new_phone_id(trans_data['userName'])
+        await run_db(insert_healthinfo, phone_id, trans_data['userName'], trans_data['userId'], trans_data['userSex'], trans_data['userAge'], trans_data['diseases'], trans_data['medication'], trans_data['injection'], trans_data['healthIssues'], trans_data['casualAlarm'])
+        await run_in_threadpool(notify_profile_changed, phone_id, trans_data['userName'])
 
         # return {"message": "Data received successfully", "data": trans_data}
     except HTTPException as e:
@@ -187,6 +336,99 @@ async def addUser(data: FormData):
         raise HTTPException(status_code=500, detail=str(e))
         return HTTPException(status_code=500, detail=str(e))
 
+
+# list-valued FormData fields, written as JSON inside a CSV cell (e.g. [["diabetes"]])
+CSV_JSON_FIELDS = ("diseases", "casualAlarm", "medication", "injection")
+
+# parse a bulk upload into [(row_number, record or None, error or None)]
+# - JSON Lines: one FormData object per line
+# - CSV: a header row with the FormData field names, list fields hold JSON, empty cells mean []
+def parse_bulk_records(body, fmt):
+    text = body.decode("utf-8-sig")
+    records = []
+
+    if fmt == "csv":
+        for row_number, row in enumerate(csv.DictReader(io.StringIO(text)), start=1):
+            try:
+                record = dict(row)
+                for field in CSV_JSON_FIELDS:
+                    record[field] = json.loads(record[field]) if record.get(field) else []
+                records.append((row_number, record, None))
+            except (json.JSONDecodeError, TypeError) as e:
+                records.append((row_number, None, f"invalid JSON in a list column: {e}"))
+    else:
+        row_number = 0
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            row_number += 1
+            try:
+                records.append((row_number, json.loads(line), None))
+            except json.JSONDecodeError as e:
+                records.append((row_number, None, f"invalid JSON: {e}"))
+
+    return records
+
+# validate every record before anything is written; returns (rows to insert, per-row errors)
+def validate_bulk_records(records):
+    errors = []
+    valid = []
+    for row_number, record, error in records:
+        if error is None:
+            try:
+                trans_data = transform_form_data(FormData(**record))
+                valid.append((row_number, trans_data))
+            except (ValidationError, ValueError, TypeError) as e:
+                error = str(e)
+        if error is not None:
+            errors.append({"row": row_number, "error": error})
+
+    # usernames have to be unique, inside the batch and against the database
+    seen = {}
+    for row_number, trans_data in valid:
+        username = trans_data["userName"]
+        if username in seen:
+            errors.append({"row": row_number, "error": f"duplicate userName '{username}' (also row {seen[username]})"})
+        seen.setdefault(username, row_number)
+
+    existing = find_existing_usernames(list(seen))
+    for row_number, trans_data in valid:
+        if trans_data["userName"] in existing:
+            errors.append({"row": row_number, "error": f"userName '{trans_data['userName']}' is already registered"})
+
+    return valid, sorted(errors, key=lambda e: e["row"])
+
+# Bulk enrollment, e.g. a whole care facility at once.
+# Everything is validated first; if any row is invalid nothing is written and every error is reported,
+# otherwise all users are written in one transaction with one executemany per table.
+@app.post("/addusers")
+async def addUsers(request: Request, format: str = None):
+    body = await request.body()
+    content_type = request.headers.get("content-type", "")
+    fmt = format or ("csv" if "csv" in content_type else "jsonl")
+    if fmt not in ("csv", "jsonl"):
+        raise HTTPException(status_code=400, detail="format must be csv or jsonl")
+
+    try:
+        valid, errors = await run_db(validate_bulk_records, parse_bulk_records(body, fmt))
+        if errors:
+            raise HTTPException(status_code=422, detail={"inserted": 0, "errors": errors})
+        if not valid:
+            raise HTTPException(status_code=400, detail="no users in the upload")
+
+        users_rows = [
+            build_user_rows(new_phone_id(t['userName']), t['userName'], t['userId'], t['userSex'], t['userAge'], t['diseases'], t['medication'], t['injection'], t['healthIssues'], t['casualAlarm'])
+            for _, t in valid
+        ]
+        await run_db(insert_user_rows, users_rows)
+
+    except pymysql.Error as error:
+        print(f"Error while connecting to MySQL: {error}")
+        raise HTTPException(status_code=500, detail=str(error))
+
+    # new phone_ids are never in the conversation server's profile cache, so no invalidation is needed
+    return {"inserted": len(users_rows), "phone_ids": [rows["user"][0] for rows in users_rows], "errors": []}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8846)
\ No newline at end of file
@@ -0,0 +1,19 @@
+
+# Importable entry point of the conversation server, used for the worker processes of run() (ELF_WORKERS > 1)
+# because the file name of the server has dots in it. It can also be served directly:
+#   hypercorn elf_asgi:app --workers 4 --bind 0.0.0.0:8845
+
+
+import importlib.util
+import os
+import sys
+
+
+SERVER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_server_1.9996_mix_eng.py")
+
+spec = importlib.util.spec_from_file_location("elf_server", SERVER_FILE)
+server = importlib.util.module_from_spec(spec)
+sys.modules["elf_server"] = server
+spec.loader.exec_module(server)
+
+app = server.app
@@ -0,0 +1,104 @@
+
+# Apply the versioned SQL files in ./migrations to the seniorcare database
+#
+#   python migrate.py            apply every pending migration
+#   python migrate.py --status   list applied / pending migrations
+#
+# A migration is a file named <version>_<name>.sql. Applied versions are recorded in schema_migrations,
+# so every file runs exactly once per database, in version order.
+
+
+import argparse
+import os
+import re
+
+import pymysql
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+MIGRATION_FILE = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+db_config = {
+    'host': os.environ.get('ELF_DB_HOST', '127.0.0.1'),
+    'user': os.environ.get('ELF_DB_USER', 'root'),
+    'password': os.environ.get('ELF_DB_PASSWORD', ''),
+    'database': os.environ.get('ELF_DB_NAME', 'seniorcare')
+}
+
+
+# [(version, name, path)] sorted by version
+def list_migrations(migrations_dir=MIGRATIONS_DIR):
+    migrations = []
+    for file_name in os.listdir(migrations_dir):
+        match = MIGRATION_FILE.match(file_name)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(migrations_dir, file_name)))
+    return sorted(migrations)
+
+
+# split a migration file into statements (no procedures/triggers, so ';' always ends a statement)
+def read_statements(path):
+    with open(path, encoding="utf-8") as f:
+        lines = [line for line in f if not line.lstrip().startswith("--")]
+    return [statement.strip() for statement in "".join(lines).split(";") if statement.strip()]
+
+
+def applied_versions(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INT PRIMARY KEY,
+                        name VARCHAR(128) NOT NULL,
+                        applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    )""")
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+# apply every pending migration on an open connection; returns the names that were applied
+def apply_migrations(connection, migrations_dir=MIGRATIONS_DIR):
+    applied = []
+    with connection.cursor() as cursor:
+        done = applied_versions(cursor)
+        for version, name, path in list_migrations(migrations_dir):
+            if version in done:
+                continue
+            # MySQL DDL commits implicitly, so a migration that fails halfway has to be fixed by hand;
+            # keep each file to statements that are safe to re-run after such a fix
+            for statement in read_statements(path):
+                cursor.execute(statement)
+            cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            connection.commit()
+            print(f"Applied migration {version:04d}_{name}")
+            applied.append(f"{version:04d}_{name}")
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply ELF database migrations")
+    parser.add_argument("--status", action="store_true", help="only list applied and pending migrations")
+    args = parser.parse_args()
+
+    try:
+        connection = pymysql.connect(**db_config)
+    except pymysql.Error as error:
+        print(f"Error while connecting to MySQL: {error}")
+        raise SystemExit(1)
+
+    try:
+        if args.status:
+            with connection.cursor() as cursor:
+                done = applied_versions(cursor)
+            for version, name, _ in list_migrations():
+                print(f"{'applied' if version in done else 'pending'}  {version:04d}_{name}")
+        else:
+            applied = apply_migrations(connection)
+            if not applied:
+                print("Database is up to date.")
+    except pymysql.Error as error:
+        print(f"Error while migrating MySQL: {error}")
+        raise SystemExit(1)
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
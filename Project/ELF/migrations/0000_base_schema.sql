@@ -0,0 +1,56 @@
+-- Base schema of the seniorcare database as the conversation server and dbinsert_web.py use it.
+-- CREATE TABLE IF NOT EXISTS keeps this a no-op on the existing production database;
+-- it is here so that fresh and scratch databases (check_query_plans.py) start from the same tables.
+
+CREATE TABLE IF NOT EXISTS user (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    phone_id VARCHAR(64),
+    username VARCHAR(64) NOT NULL,
+    userid VARCHAR(64),
+    usersex VARCHAR(16),
+    userage INT
+) DEFAULT CHARSET = utf8mb4;
+
+CREATE TABLE IF NOT EXISTS alarm (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    phone_id VARCHAR(64),
+    username VARCHAR(64) NOT NULL,
+    casual_alarm_time TEXT,
+    med_alarm_time TEXT
+) DEFAULT CHARSET = utf8mb4;
+
+CREATE TABLE IF NOT EXISTS healthinfo (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    phone_id VARCHAR(64),
+    username VARCHAR(64) NOT NULL,
+    disease TEXT,
+    medication TEXT,
+    injection TEXT,
+    healthissue TEXT
+) DEFAULT CHARSET = utf8mb4;
+
+CREATE TABLE IF NOT EXISTS context (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    session_id VARCHAR(96) NOT NULL,
+    unique_number INT NOT NULL,
+    created_at DATETIME NOT NULL,
+    phone_id VARCHAR(64),
+    username VARCHAR(64),
+    conversation_start VARCHAR(64),
+    model VARCHAR(64),
+    role VARCHAR(32),
+    content TEXT,
+    audio_file_dir VARCHAR(255)
+) DEFAULT CHARSET = utf8mb4;
+
+CREATE TABLE IF NOT EXISTS summarization (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    session_id VARCHAR(96) NOT NULL,
+    summ_created_at DATETIME NOT NULL,
+    phone_id VARCHAR(64),
+    username VARCHAR(64),
+    conversation_start VARCHAR(64),
+    summary_model VARCHAR(64),
+    summary TEXT,
+    next_first_question TEXT
+) DEFAULT CHARSET = utf8mb4;
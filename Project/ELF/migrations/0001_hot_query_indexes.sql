@@ -0,0 +1,28 @@
+-- Composite indexes for the queries in queries.py.
+-- Every table is altered once so each gets a single (online) index build.
+
+-- profile lookup by phone_id, phoneid_db_search_update by username
+ALTER TABLE user
+    ADD INDEX idx_user_phone_id (phone_id),
+    ADD INDEX idx_user_username (username);
+
+ALTER TABLE alarm
+    ADD INDEX idx_alarm_phone_id (phone_id),
+    ADD INDEX idx_alarm_username (username);
+
+ALTER TABLE healthinfo
+    ADD INDEX idx_healthinfo_phone_id (phone_id),
+    ADD INDEX idx_healthinfo_username (username);
+
+-- latest session / last 20 rows of a phone_id (ORDER BY created_at DESC LIMIT n),
+-- one session in order (WHERE session_id = ? ORDER BY created_at)
+ALTER TABLE context
+    ADD INDEX idx_context_phone_created (phone_id, created_at),
+    ADD INDEX idx_context_session_created (session_id, created_at),
+    ADD INDEX idx_context_username (username);
+
+-- latest summarization of a phone_id (ORDER BY summ_created_at DESC LIMIT 1) and the join back on session_id
+ALTER TABLE summarization
+    ADD INDEX idx_summarization_phone_created (phone_id, summ_created_at),
+    ADD INDEX idx_summarization_session (session_id),
+    ADD INDEX idx_summarization_username (username);
@@ -0,0 +1,50 @@
+-- Per-user "current state" row, maintained on every summarization and context insert,
+-- so that loading a profile or a greeting is a primary key lookup instead of
+-- "ORDER BY summ_created_at / created_at DESC LIMIT 1" over the whole history of a user.
+
+CREATE TABLE IF NOT EXISTS user_state (
+    phone_id VARCHAR(64) NOT NULL PRIMARY KEY,
+    username VARCHAR(64),
+    -- latest summarization
+    summary_session_id VARCHAR(96),
+    conversation_start VARCHAR(64),
+    summary TEXT,
+    next_first_question TEXT,
+    summ_created_at DATETIME,
+    -- latest context row
+    context_session_id VARCHAR(96),
+    context_created_at DATETIME,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX idx_user_state_username (username)
+) DEFAULT CHARSET = utf8mb4;
+
+-- backfill from the existing history (one-time full pass)
+INSERT INTO user_state (phone_id, username, summary_session_id, conversation_start, summary, next_first_question, summ_created_at)
+SELECT s.phone_id, s.username, s.session_id, s.conversation_start, s.summary, s.next_first_question, s.summ_created_at
+FROM summarization s
+JOIN (
+    SELECT phone_id, MAX(summ_created_at) AS latest
+    FROM summarization
+    WHERE phone_id IS NOT NULL
+    GROUP BY phone_id
+) m ON s.phone_id = m.phone_id AND s.summ_created_at = m.latest
+ON DUPLICATE KEY UPDATE
+    username = VALUES(username),
+    summary_session_id = VALUES(summary_session_id),
+    conversation_start = VALUES(conversation_start),
+    summary = VALUES(summary),
+    next_first_question = VALUES(next_first_question),
+    summ_created_at = VALUES(summ_created_at);
+
+INSERT INTO user_state (phone_id, username, context_session_id, context_created_at)
+SELECT c.phone_id, c.username, c.session_id, c.created_at
+FROM context c
+JOIN (
+    SELECT phone_id, MAX(created_at) AS latest
+    FROM context
+    WHERE phone_id IS NOT NULL
+    GROUP BY phone_id
+) m ON c.phone_id = m.phone_id AND c.created_at = m.latest
+ON DUPLICATE KEY UPDATE
+    context_session_id = VALUES(context_session_id),
+    context_created_at = VALUES(context_created_at);
@@ -0,0 +1,98 @@
+
+# SQL used on the hot paths of the conversation server (and the user_state upserts shared with dbinsert_web.py).
+# Kept in one module so that check_query_plans.py can EXPLAIN exactly what production runs.
+
+
+# full user profile (user + alarm + healthinfo + latest summary from user_state) for one phone_id
+USER_PROFILE = """SELECT
+                        user.phone_id,
+                        user.username,
+                        user.userid,
+                        user.usersex,
+                        user.userage,
+                        healthinfo.disease,
+                        alarm.casual_alarm_time,
+                        healthinfo.medication,
+                        healthinfo.injection,
+                        healthinfo.healthissue,
+                        user_state.conversation_start,
+                        user_state.summary,
+                        user_state.next_first_question
+                    FROM
+                        user
+                    JOIN
+                        alarm ON user.phone_id = alarm.phone_id
+                    JOIN
+                        healthinfo ON user.phone_id = healthinfo.phone_id
+                    JOIN
+                        user_state ON user.phone_id = user_state.phone_id
+                    WHERE
+                        user.phone_id = %s
+                        -- like the join on summarization before user_state : users without a summary have no profile yet
+                        AND user_state.summary_session_id IS NOT NULL;"""
+
+# next_first_question of the latest summarization of one phone_id
+LATEST_NEXT_FIRST_QUESTION = "SELECT next_first_question FROM user_state WHERE phone_id = %s;"
+
+# conversation of one session
+SESSION_CONVERSATION = """SELECT session_id, conversation_start, role, content
+        FROM context
+        WHERE session_id = %s
+        ORDER BY created_at ASC;"""
+
+# conversation of the latest session of one phone_id
+LATEST_SESSION_CONVERSATION = """SELECT session_id, conversation_start, role, content
+        FROM context
+        WHERE session_id = (
+            SELECT context_session_id FROM user_state WHERE phone_id = %s
+        ) ORDER BY created_at ASC;"""
+
+# last 20 context rows of one phone_id, oldest first (chat history shown in the app)
+RECENT_HISTORY = """SELECT created_at, role, content
+                    FROM (
+                        SELECT created_at, role, content
+                        FROM context
+                        WHERE phone_id = %s
+                        ORDER BY created_at DESC
+                        LIMIT 20
+                    ) AS subquery
+                    ORDER BY created_at ASC;"""
+
+# every phone_id that has alarms (deliberately a full listing)
+ALARM_PHONE_IDS = "SELECT phone_id FROM alarm;"
+
+USERNAME_EXISTS = "SELECT username FROM user WHERE username = %s;"
+
+# re-bind every row of a user to a new phone_id, table by table
+PHONE_ID_UPDATES = {
+    table: f"UPDATE {table} SET phone_id = %s WHERE username = %s;"
+    for table in ("user", "alarm", "healthinfo", "context", "summarization", "user_state")
+}
+
+INSERT_CONTEXT = """
+        INSERT INTO context (session_id, unique_number, created_at, phone_id, username, conversation_start, model, role, content, audio_file_dir)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
+
+INSERT_SUMMARIZATION = "INSERT INTO summarization (session_id, summ_created_at, phone_id, username, conversation_start, summary_model, summary, next_first_question) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
+
+# keep user_state pointing at the latest summarization / context row of a user.
+# Rows that arrive out of order (retried summaries, replayed journals) never move the pointer back;
+# the timestamp column is assigned last because MySQL applies the assignments left to right.
+UPSERT_SUMMARY_STATE = """
+        INSERT INTO user_state (phone_id, username, summary_session_id, conversation_start, summary, next_first_question, summ_created_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            username = VALUES(username),
+            summary_session_id = IF(summ_created_at IS NULL OR VALUES(summ_created_at) >= summ_created_at, VALUES(summary_session_id), summary_session_id),
+            conversation_start = IF(summ_created_at IS NULL OR VALUES(summ_created_at) >= summ_created_at, VALUES(conversation_start), conversation_start),
+            summary = IF(summ_created_at IS NULL OR VALUES(summ_created_at) >= summ_created_at, VALUES(summary), summary),
+            next_first_question = IF(summ_created_at IS NULL OR VALUES(summ_created_at) >= summ_created_at, VALUES(next_first_question), next_first_question),
+            summ_created_at = IF(summ_created_at IS NULL OR VALUES(summ_created_at) >= summ_created_at, VALUES(summ_created_at), summ_created_at)"""
+
+UPSERT_CONTEXT_STATE = """
+        INSERT INTO user_state (phone_id, username, context_session_id, context_created_at)
+        VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            username = VALUES(username),
+            context_session_id = IF(context_created_at IS NULL OR VALUES(context_created_at) >= context_created_at, VALUES(context_session_id), context_session_id),
+            context_created_at = IF(context_created_at IS NULL OR VALUES(context_created_at) >= context_created_at, VALUES(context_created_at), context_created_at)"""
@@ -0,0 +1,230 @@
+
+# Shared state of the conversation server workers
+#
+# A websocket lives in one worker process and its session (context, prompt builder, actor) stays in that worker.
+# What the workers share is which worker owns the socket of each phone_id (SessionStore) and a pub/sub channel
+# (PubSub), so any worker can send a message to any connected app, and broadcasts and cache invalidations
+# reach every worker. The store also keeps short-lived entries that any worker takes once (pre-generated greetings).
+#   - InMemorySessionStore / InMemoryPubSub : a single process (the default, and for tests)
+#   - RedisSessionStore / RedisPubSub       : a Redis server shared by the workers of every node (optional dependency)
+#
+# Ownership entries expire after ttl seconds unless the owner refreshes them, so the sockets of a worker that
+# died are not routed to it forever.
+
+
+import asyncio
+import json
+import time
+from abc import ABC, abstractmethod
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+
+class SessionStore(ABC):
+    name = "session_store"
+
+    # record worker_id as the owner of phone_id, returns the previous owner (None if there was none)
+    @abstractmethod
+    async def claim(self, phone_id, worker_id):
+        ...
+
+    # extend the ownership of the given phone_ids that worker_id still owns
+    @abstractmethod
+    async def refresh(self, phone_ids, worker_id):
+        ...
+
+    # drop the ownership if worker_id still owns phone_id (a newer connection on another worker is kept)
+    @abstractmethod
+    async def release(self, phone_id, worker_id):
+        ...
+
+    # worker_id that owns phone_id, None if the app is not connected
+    @abstractmethod
+    async def owner(self, phone_id):
+        ...
+
+    # keep a json value under key for ttl seconds
+    @abstractmethod
+    async def put_shared(self, key, value, ttl):
+        ...
+
+    # remove and return the value under key, None if it is missing or expired (only one worker gets it)
+    @abstractmethod
+    async def pop_shared(self, key):
+        ...
+
+    async def close(self):
+        pass
+
+
+class PubSub(ABC):
+    name = "pubsub"
+
+    @abstractmethod
+    async def publish(self, channel, message):
+        ...
+
+    # async iterator of (channel, message) for every message published on channels
+    @abstractmethod
+    def listen(self, channels):
+        ...
+
+    async def close(self):
+        pass
+
+
+class InMemorySessionStore(SessionStore):
+    name = "memory"
+
+    def __init__(self):
+        self.owners = {}    # phone_id -> worker_id
+        self.shared = {}    # key -> (json value, expiry on the monotonic clock)
+
+    async def claim(self, phone_id, worker_id):
+        previous = self.owners.get(phone_id)
+        self.owners[phone_id] = worker_id
+        return previous
+
+    async def refresh(self, phone_ids, worker_id):
+        return sum(1 for phone_id in phone_ids if self.owners.get(phone_id) == worker_id)
+
+    async def release(self, phone_id, worker_id):
+        if self.owners.get(phone_id) != worker_id:
+            return False
+        del self.owners[phone_id]
+        return True
+
+    async def owner(self, phone_id):
+        return self.owners.get(phone_id)
+
+    async def put_shared(self, key, value, ttl):
+        now = time.monotonic()
+        for expired in [k for k, (_, expires_at) in self.shared.items() if expires_at < now]:
+            del self.shared[expired]
+        self.shared[key] = (json.dumps(value, ensure_ascii=False), now + ttl)
+
+    async def pop_shared(self, key):
+        data, expires_at = self.shared.pop(key, (None, 0))
+        if data is None or expires_at < time.monotonic():
+            return None
+        return json.loads(data)
+
+
+class InMemoryPubSub(PubSub):
+    name = "memory"
+
+    def __init__(self):
+        self.subscribers = {}   # channel -> set of subscriber queues
+
+    async def publish(self, channel, message):
+        # the same serialization as over the network, so messages that only work in memory fail here too
+        data = json.dumps(message, ensure_ascii=False)
+        for queue in list(self.subscribers.get(channel, ())):
+            queue.put_nowait((channel, json.loads(data)))
+
+    async def listen(self, channels):
+        queue = asyncio.Queue()
+        for channel in channels:
+            self.subscribers.setdefault(channel, set()).add(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            for channel in channels:
+                self.subscribers[channel].discard(queue)
+
+
+# compare-and-delete / compare-and-expire, so a worker never drops or extends a newer owner's entry
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+REFRESH_SCRIPT = """
+local refreshed = 0
+for _, key in ipairs(KEYS) do
+    if redis.call('get', key) == ARGV[1] then
+        redis.call('expire', key, ARGV[2])
+        refreshed = refreshed + 1
+    end
+end
+return refreshed
+"""
+
+
+class RedisSessionStore(SessionStore):
+    name = "redis"
+
+    def __init__(self, client, ttl=120, prefix="elf:owner:", shared_prefix="elf:shared:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.shared_prefix = shared_prefix
+        self.release_script = client.register_script(RELEASE_SCRIPT)
+        self.refresh_script = client.register_script(REFRESH_SCRIPT)
+
+    def _key(self, phone_id):
+        return f"{self.prefix}{phone_id}"
+
+    async def claim(self, phone_id, worker_id):
+        return await self.client.set(self._key(phone_id), worker_id, ex=self.ttl, get=True)
+
+    async def refresh(self, phone_ids, worker_id):
+        if not phone_ids:
+            return 0
+        return await self.refresh_script(keys=[self._key(phone_id) for phone_id in phone_ids], args=[worker_id, self.ttl])
+
+    async def release(self, phone_id, worker_id):
+        return bool(await self.release_script(keys=[self._key(phone_id)], args=[worker_id]))
+
+    async def owner(self, phone_id):
+        return await self.client.get(self._key(phone_id))
+
+    async def put_shared(self, key, value, ttl):
+        await self.client.set(f"{self.shared_prefix}{key}", json.dumps(value, ensure_ascii=False), ex=max(1, int(ttl)))
+
+    async def pop_shared(self, key):
+        data = await self.client.getdel(f"{self.shared_prefix}{key}")
+        return json.loads(data) if data is not None else None
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class RedisPubSub(PubSub):
+    name = "redis"
+
+    def __init__(self, client):
+        self.client = client
+
+    async def publish(self, channel, message):
+        await self.client.publish(channel, json.dumps(message, ensure_ascii=False))
+
+    async def listen(self, channels):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(*channels)
+        try:
+            async for item in pubsub.listen():
+                if item["type"] == "message":
+                    yield item["channel"], json.loads(item["data"])
+        finally:
+            await pubsub.aclose()
+
+
+# build the store and the pub/sub channel selected by url:
+#   memory           : in-process only (one worker)
+#   redis://host:port/db : shared by every worker that uses the same Redis server
+def create_session_backend(url="memory", ttl=120):
+    if url == "memory":
+        return InMemorySessionStore(), InMemoryPubSub()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        if aioredis is None:
+            raise ImportError("the redis session backend requires redis (pip install redis)")
+        client = aioredis.from_url(url, decode_responses=True)
+        return RedisSessionStore(client, ttl=ttl), RedisPubSub(client)
+    raise ValueError(f"unknown session backend: {url}")
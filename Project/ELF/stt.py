@@ -0,0 +1,186 @@
+
+# Speech-to-text backends used by the conversation server
+#
+# Every backend takes the raw pcm of one utterance as sent by the app (16kHz, mono, 16-bit little endian)
+# and returns its text, so the audio never has to be written to and read back from disk first.
+#   - OpenAIWhisperSTT : whisper-1 through the OpenAI API (the audio is wrapped in an in-memory wav)
+#   - LocalWhisperSTT  : faster-whisper on the local CPU, model loaded once at startup (optional dependency)
+#   - FallbackSTT      : a primary backend that falls back to a second one on errors or timeouts
+
+
+from abc import ABC, abstractmethod
+import io
+import threading
+import time
+import wave
+
+try:
+    import numpy as np
+    from faster_whisper import WhisperModel
+except ImportError:
+    np = None
+    WhisperModel = None
+
+
+PCM_SAMPLE_RATE = 16000
+PCM_SAMPLE_WIDTH = 2
+
+
+def pcm_duration(pcm):
+    return len(pcm) / (PCM_SAMPLE_RATE * PCM_SAMPLE_WIDTH)
+
+
+# wrap raw pcm into wav bytes without touching the disk
+def pcm_to_wav_bytes(pcm, sample_rate=PCM_SAMPLE_RATE):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(PCM_SAMPLE_WIDTH)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm)
+    return buffer.getvalue()
+
+
+class STTBackend(ABC):
+    name = "stt"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.audio_seconds = 0.0
+
+    # load models etc. (called once at server startup)
+    def load(self):
+        pass
+
+    @abstractmethod
+    def _transcribe(self, pcm):
+        ...
+
+    def transcribe(self, pcm):
+        started = time.perf_counter()
+        try:
+            return self._transcribe(pcm)
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            raise
+        finally:
+            with self.lock:
+                self.requests += 1
+                self.busy_seconds += time.perf_counter() - started
+                self.audio_seconds += pcm_duration(pcm)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "backend": self.name,
+                "requests": self.requests,
+                "errors": self.errors,
+                "avg_latency_ms": (self.busy_seconds / self.requests * 1000) if self.requests else 0.0,
+                # processing time per second of speech (< 1 means faster than real time)
+                "real_time_factor": (self.busy_seconds / self.audio_seconds) if self.audio_seconds else 0.0,
+            }
+
+
+class OpenAIWhisperSTT(STTBackend):
+    name = "openai"
+
+    def __init__(self, client, model="whisper-1", language=None, timeout=None):
+        super().__init__()
+        # no retries with a timeout : a slow upstream has to fail fast so the fallback backend can answer
+        self.client = client.with_options(timeout=timeout, max_retries=0) if timeout else client
+        self.model = model
+        self.language = language
+
+    def _transcribe(self, pcm):
+        kwargs = {"language": self.language} if self.language else {}
+        return self.client.audio.transcriptions.create(
+            model=self.model,
+            file=("speech.wav", pcm_to_wav_bytes(pcm), "audio/wav"),
+            response_format="text",
+            **kwargs
+        ).strip()
+
+
+# Whisper on the local CPU with faster-whisper (CTranslate2).
+# The model is loaded once; num_workers model workers run transcriptions in parallel
+# and further requests wait for a free worker.
+class LocalWhisperSTT(STTBackend):
+    name = "local"
+
+    def __init__(self, model_size="small", device="cpu", compute_type="int8", cpu_threads=4, num_workers=2,
+                 language=None, beam_size=1):
+        super().__init__()
+        if WhisperModel is None:
+            raise ImportError("LocalWhisperSTT requires faster-whisper (pip install faster-whisper)")
+        self.model_size = model_size
+        self.device = device
+        self.compute_type = compute_type
+        self.cpu_threads = cpu_threads
+        self.num_workers = num_workers
+        self.language = language
+        self.beam_size = beam_size
+        self.model = None
+        self.load_lock = threading.Lock()
+        self.workers = threading.BoundedSemaphore(num_workers)
+
+    def load(self):
+        with self.load_lock:
+            if self.model is None:
+                started = time.perf_counter()
+                self.model = WhisperModel(self.model_size, device=self.device, compute_type=self.compute_type,
+                                          cpu_threads=self.cpu_threads, num_workers=self.num_workers)
+                print(f"Local STT model '{self.model_size}' loaded in {time.perf_counter() - started:.1f}s")
+
+    def _transcribe(self, pcm):
+        self.load()
+        audio = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+        with self.workers:
+            segments, _ = self.model.transcribe(audio, language=self.language, beam_size=self.beam_size)
+            # segments is a generator : decoding happens while it is consumed, so keep it inside the worker slot
+            return "".join(segment.text for segment in segments).strip()
+
+
+class FallbackSTT(STTBackend):
+    def __init__(self, primary, fallback):
+        super().__init__()
+        self.primary = primary
+        self.fallback = fallback
+        self.name = f"{primary.name}+{fallback.name}"
+        self.fallbacks = 0
+
+    def load(self):
+        self.primary.load()
+        self.fallback.load()
+
+    def _transcribe(self, pcm):
+        try:
+            return self.primary.transcribe(pcm)
+        except Exception as e:
+            print(f"STT backend {self.primary.name} failed ({e}), using {self.fallback.name}")
+            with self.lock:
+                self.fallbacks += 1
+            return self.fallback.transcribe(pcm)
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({"fallbacks": self.fallbacks, "primary": self.primary.stats(), "fallback": self.fallback.stats()})
+        return stats
+
+
+# build the backend selected by name:
+#   openai : whisper-1 only
+#   local  : local faster-whisper only
+#   auto   : whisper-1 with a short timeout, local faster-whisper when the upstream is slow or failing
+def create_stt_backend(name, openai_client, local_model="small", local_workers=2, language=None, openai_timeout=8.0):
+    if name == "openai":
+        return OpenAIWhisperSTT(openai_client, language=language)
+    if name == "local":
+        return LocalWhisperSTT(local_model, num_workers=local_workers, language=language)
+    if name == "auto":
+        return FallbackSTT(OpenAIWhisperSTT(openai_client, language=language, timeout=openai_timeout),
+                           LocalWhisperSTT(local_model, num_workers=local_workers, language=language))
+    raise ValueError(f"unknown STT backend: {name}")
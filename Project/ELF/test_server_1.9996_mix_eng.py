@@ -5,18 +5,43 @@ from datetime import datetime, timedelta
 from datetime import time as dt
 from pytz import timezone
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, HTTPException
 
 from typing import List, Dict
 from openai import OpenAI
 from dotenv import load_dotenv, find_dotenv
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing, closing
+
+from db_pool import ConnectionPool
+from stt import create_stt_backend
+from vad import VoiceActivityTrimmer
+from audio_archive import AudioArchiver
+from tts_cache import TTSCache
+from session_store import create_session_backend
+import queries
 
 import pymysql
+import asyncio
+import bisect
+import concurrent.futures
+import functools
+import threading
+import time
 import base64
-import requests
+import io
+import httpx
+import struct
 import wave
 import json
 import os
+import platform
+import re
+
+try:
+    import fcntl
+except ImportError: # windows : a single worker
+    fcntl = None
 
 # database config information
 db_config = {
@@ -26,6 +51,13 @@ db_config = {
     'database': 'seniorcare'
 }
 
+# shared, bounded MySQL connection pool used by every database helper below
+db_pool = ConnectionPool(
+    db_config,
+    max_size=int(os.environ.get('ELF_DB_POOL_SIZE', '10')),
+    max_lifetime=int(os.environ.get('ELF_DB_POOL_MAX_LIFETIME', '1800'))
+)
+
 
 # Load environment variables from a .env file
 _ = load_dotenv(find_dotenv()) # Load the .env file
@@ -35,61 +67,101 @@ openai_client = OpenAI(
     api_key=os.environ['OPENAI_API_KEY'],  # Retrieves API key from environment variables
 )
 
+# OpenAI, MySQL and file work is blocking, so it runs on a bounded thread pool
+# instead of the event loop. Otherwise one user's Whisper or gpt-4o call freezes every other connected phone.
+blocking_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('ELF_WORKER_THREADS', '32')),
+    thread_name_prefix='elf-worker'
+)
+
+# run a blocking function on blocking_executor and await its result
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, functools.partial(func, *args, **kwargs))
+
+# run_blocking for work that changes session state : when the caller is cancelled,
+# the cancellation goes on only after func has returned (a running thread cannot be interrupted)
+async def run_blocking_to_completion(func, *args, **kwargs):
+    future = asyncio.ensure_future(run_blocking(func, *args, **kwargs))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        raise
+
+
+class _StreamError:
+    def __init__(self, error):
+        self.error = error
+
+_STREAM_END = object()
+
+# iterate a blocking generator (e.g. an OpenAI streaming response) on blocking_executor
+# and yield its items on the event loop as they arrive.
+# When the consumer stops early, the generator is closed so the upstream HTTP stream is released.
+async def iterate_blocking(gen_func, *args, maxsize=16):
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while True:
+            try:
+                future.result(timeout=0.5)
+                return True
+            except concurrent.futures.TimeoutError:
+                if stop.is_set():
+                    future.cancel()
+                    return False
+
+    def produce():
+        try:
+            with closing(gen_func(*args)) as items:
+                for item in items:
+                    if not put(item) or stop.is_set():
+                        return
+        except Exception as e:
+            put(_StreamError(e))
+            return
+        put(_STREAM_END)
+
+    producer = loop.run_in_executor(blocking_executor, produce)
+    try:
+        while True:
+            item = await queue.get()
+            if item is _STREAM_END:
+                break
+            if isinstance(item, _StreamError):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        while not queue.empty(): # unblock a pending put
+            queue.get_nowait()
+        # the consumer goes on only after the generator is closed (also when it is cancelled, e.g. by a barge-in),
+        # so whatever the generator still does to the session cannot overlap with the next turn
+        await asyncio.wait([producer])
+
 
 # Import user information from database
 class UserInfo:
-    def __init__(self, db_config):
-        self.db_config = db_config
+    def __init__(self, pool):
+        self.pool = pool
 
         # get total raw userinformation from mysql db using phone_id
     def get_total_userinfo_from_db(self, phone_id):
         try:
             # Connection with MySQL database
-            connection = pymysql.connect(**self.db_config)
-            cursor = connection.cursor()
+            with self.pool.connection() as connection, connection.cursor() as cursor:
             
-            query = """SELECT 
-                            user.phone_id, 
-                            user.username, 
-                            user.userid, 
-                            user.usersex, 
-                            user.userage,
-                            healthinfo.disease,
-                            alarm.casual_alarm_time, 
-                            healthinfo.medication,
-                            healthinfo.injection, 
-                            healthinfo.healthissue,
-                            summarization.conversation_start,
-                            summarization.summary
-                        FROM 
-                            user 
-                        JOIN 
-                            alarm ON user.phone_id = alarm.phone_id 
-                        JOIN 
-                            healthinfo ON user.phone_id = healthinfo.phone_id
-                        JOIN 
-                            summarization ON user.phone_id = summarization.phone_id
-                        WHERE 
-                            user.phone_id = %s
-                            AND summarization.session_id = (
-                                SELECT session_id 
-                                FROM summarization 
-                                WHERE phone_id = %s 
-                                ORDER BY summ_created_at DESC 
-                                LIMIT 1
-                            );"""
-            values = (phone_id, phone_id)
-            
-            cursor.execute(query, values)
-            total_userinfo_db = cursor.fetchall()
+                cursor.execute(queries.USER_PROFILE, (phone_id,))
+                total_userinfo_db = cursor.fetchall()
 
         except pymysql.Error as error:
             print(f"Error while connecting to MySQL: {error}")
             total_userinfo_db = None
 
-        finally:
-            cursor.close()
-            connection.close()
             
         return total_userinfo_db
 
@@ -165,64 +237,379 @@ class UserInfo:
             "health_inj_alarm": self.process_alarms(data[0][8]) if "null" not in data[0][8] else [],
             "healthissue": data[0][9] if data[0][9] is not None else [],
             "prev_conversation_start": data[0][10] if "null" not in data[0][10] else [], #mix
-            "prev_summary": data[0][11] if "null" not in data[0][11] else [] #mix
+            "prev_summary": data[0][11] if "null" not in data[0][11] else [], #mix
+            "prev_next_first_question": data[0][12]
         }
+        user_info["alarm_schedule"] = AlarmSchedule(user_info)
         
         return user_info
 
 
+# Alarm times of a user compiled once per profile load : for each alarm kind a sorted array of
+# minute-of-day in korean time, so the alarm nearest to a time is found with bisect.
+class AlarmSchedule:
+    kinds = ('casualalarm', 'health_med_alarm', 'health_inj_alarm') # later kinds win when alarms of several kinds are close
+
+    def __init__(self, user_info):
+        self.minutes = {}
+        # alarms in korean time for prompts (what adjust_times(alarm, 9) used to compute on every turn)
+        self.korea_alarm_time = {}
+        for kind in self.kinds:
+            alarms = user_info.get(kind) or []
+            self.minutes[kind] = sorted({(t.hour * 60 + t.minute + 9 * 60) % 1440 for alarm in alarms for times in alarm.values() for t in times})
+            self.korea_alarm_time[kind] = adjust_times(alarms, 9)
+
+    # (alarm time, kind) of the alarm within `within` of time_obj, (None, None) if there is none
+    def find_close_alarm(self, time_obj, within=timedelta(minutes=3)):
+        second_of_day = time_obj.hour * 3600 + time_obj.minute * 60 + time_obj.second
+        close_time, close_key = None, None
+        for kind in self.kinds:
+            minutes = self.minutes[kind]
+            if not minutes:
+                continue
+            # the nearest alarm is one of the two neighbours of the insertion point (wrapping around midnight)
+            index = bisect.bisect_left(minutes, second_of_day / 60)
+            distance, nearest = min((min(abs(m * 60 - second_of_day), 86400 - abs(m * 60 - second_of_day)), m)
+                                    for m in (minutes[index % len(minutes)], minutes[index - 1]))
+            if distance <= within.total_seconds():
+                close_time, close_key = dt(nearest // 60, nearest % 60), kind
+        return close_time, close_key
+
+    def all_alarms(self):
+        return [(minute, kind) for kind in self.kinds for minute in self.minutes[kind]]
+
+
+# Alarms of all users merged into one sorted timetable of (minute-of-day, phone_id, kind),
+# answering "which users have an alarm in the next N minutes" with bisect.
+class AlarmTimetable:
+    def __init__(self):
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def rebuild(self, user_infos):
+        entries = sorted((minute, phone_id, kind)
+                         for phone_id, user_info in user_infos.items()
+                         for minute, kind in user_info["alarm_schedule"].all_alarms())
+        with self.lock:
+            self.entries = entries
+
+    # alarms from minute_of_day (inclusive) for the next n_minutes, across midnight
+    def upcoming(self, minute_of_day, n_minutes):
+        with self.lock:
+            entries = self.entries
+        end = minute_of_day + n_minutes
+        start_index = bisect.bisect_left(entries, (minute_of_day,))
+        result = entries[start_index:bisect.bisect_left(entries, (min(end, 1440),))]
+        if end > 1440:
+            result = result + entries[:bisect.bisect_left(entries, (end - 1440,))]
+        return result
+
+
+alarm_timetable = AlarmTimetable()
+
+
+# token counter for prompt budgeting (tiktoken if installed, otherwise about 4 characters per token)
+try:
+    import tiktoken
+    _token_encoding = tiktoken.get_encoding("o200k_base") # tokenizer of gpt-4o
+
+    def count_tokens(text):
+        return len(_token_encoding.encode(text))
+except Exception:
+    def count_tokens(text):
+        return len(text) // 4 + 1
+
+
+# Conversation of a session kept for the prompt.
+# Recent turns are sent as they are within token_budget, and older turns are folded into a rolling summary by compact(),
+# so the prompt size stays bounded however long the conversation runs.
+# Compaction has hysteresis : it starts only when the turns exceed token_budget (high-water mark) and then folds
+# turns until the rest fits in low_water_tokens, so the summary is updated once every several turns, not on every turn.
+# It behaves like the list of {"role", "content"} dicts that was used before (append, iteration, indexing).
+class ConversationContext:
+    def __init__(self, token_budget=None, low_water_ratio=0.5):
+        self.token_budget = token_budget or int(os.environ.get('ELF_CONTEXT_TOKEN_BUDGET', '1500'))
+        self.low_water_tokens = int(self.token_budget * low_water_ratio)
+        self.turns = []
+        self.turn_tokens = []
+        self.summary = ""
+        self.lock = threading.Lock()    # compact() runs in the background while the next turns are appended
+        self.compacting = False
+
+    def append(self, turn):
+        tokens = count_tokens(f"{turn['role']}: {turn['content']}")
+        with self.lock:
+            self.turns.append(turn)
+            self.turn_tokens.append(tokens)
+
+    def __iter__(self):
+        return iter(self.turns)
+
+    def __len__(self):
+        return len(self.turns)
+
+    def __getitem__(self, index):
+        return self.turns[index]
+
+    # index of the first turn that fits in the token budget (the latest turn is always kept)
+    def _window_start(self):
+        used = 0
+        start = len(self.turns)
+        while start > 0 and (used + self.turn_tokens[start - 1] <= self.token_budget or start == len(self.turns)):
+            start -= 1
+            used += self.turn_tokens[start]
+        return start
+
+    # recent turns that fit in the token budget
+    def window(self):
+        with self.lock:
+            return self.turns[self._window_start():]
+
+    # tokens of the turns returned by window() (counted once, when each turn was appended)
+    def window_tokens(self):
+        with self.lock:
+            return sum(self.turn_tokens[self._window_start():])
+
+    # the turns passed the high-water mark and no compaction is running
+    def needs_compaction(self):
+        with self.lock:
+            return not self.compacting and sum(self.turn_tokens) > self.token_budget
+
+    # fold the oldest turns into the rolling summary using summarize(summary, turns), down to the low-water mark.
+    # summarize runs without the lock, so turns can be appended (and prompts built) meanwhile.
+    def compact(self, summarize):
+        with self.lock:
+            if self.compacting or sum(self.turn_tokens) <= self.token_budget:
+                return False
+            count, remaining = 0, sum(self.turn_tokens)
+            while count < len(self.turns) - 1 and remaining > self.low_water_tokens:
+                remaining -= self.turn_tokens[count]
+                count += 1
+            older_turns, summary = self.turns[:count], self.summary
+            self.compacting = True
+
+        try:
+            summary = summarize(summary, older_turns)
+        except Exception:
+            with self.lock:
+                self.compacting = False
+            raise
+
+        with self.lock:
+            # turns are only appended meanwhile, so the folded ones are still the first count
+            self.summary = summary
+            del self.turns[:count]
+            del self.turn_tokens[:count]
+            self.compacting = False
+        return True
+
+
+# system prompt of the conversation; the {fields} are the static information of the user
+CHAT_SYSTEM_PROMPT = """The following is a friendly conversation between a human and an assistant.
+                The assistant should talk to the elderly like a friendly neighbor.
+                The assistant uses casual and informal conversation style.
+                The assistant cares about the health, daily life, and family of the elderly.    
+                The assistant is talking to the elderly who wants to have friendly conversation. 
+                The assistant is to help the elderly relieve their depression or gloomy mood by having a conversation. 
+                The assistant should not use difficult words or phrases, and should be patient and understanding.
+                The assistant should give a question to the elderly to keep the conversation going.
+                The assistant speaks only English and is designed to help the elderly who can understand only english.
+                
+                The assistant must respond "shortly" with no more than three sentences each time.
+                Remember to keep the conversation friendly and casual like a chat buddy.
+                Below is friendly and casual statement for the assistant to use.
+                ex) Oh, I heard your knee’s been bothering you and you haven’t been able to exercise. 
+                    My grandma went through the same thing. But don’t give up! Try doing some light exercises like swimming or stretching. If you keep at it, you’ll get stronger and it won’t hurt as much. You can do it, seriously. Go for it!
+
+                The assistant should understand and internalize the given user information and engage in conversation with the user based on this information.
+                User information = username : {username}, user gdnder : {usersex}, user age : {userage}
+                
+                - User health information that the assistant can reference during the conversation:
+                The user's illnesses or diseases : {user_diseases}
+                The user's medication the user needs to take and the times they need to take it : {korea_medication_alarm}
+                The user's injection medication the user needs to take and the times they need to take it: {korea_injection_alarm}
+                The user's other healthissues : {user_healthissues}"""
+
+# system prompt of med_regular_greeting
+MED_GREETING_SYSTEM_PROMPT = """The assistant greets the user based on the given user info and user health information.
+              The assistant should talk to the elderly like a friendly neighbor.
+              The assistant uses casual and informal conversation style.
+              The assistant is talking to the elderly who wants to have friendly conversation. 
+              The assistant should not use difficult words or phrases, and should be patient and understanding.
+              The assistant speaks only English and is designed to help the elderly who can understand only english.
+
+                The assistant should greet the user based on the given user personal information and user health information.
+                if current time is within the user's medication time or injection time, the assistant should ask the user whether the user have a medicine or injection.
+                - User information 
+                    username : {username}, user gender : {usersex}, user age : {userage}
+                - User health information :
+                    The user's illnesses or diseases : {user_diseases}
+                    The medication that the user must take and the times the users need to take it, and assistant should ask the user whether the user have a medicine : {korea_medication_alarm}
+                    The injection medication that the user must inject themselves and the times the users need to take it, and the assistant should ask the user whether the user have an injection : {korea_injection_alarm}
+                    If the current time is within 3 minutes of the user’s medication time or injection time, the assistant should briefly ask the user whether they have taken their medicine or injection, including a greeting message.
+                    The user's health issues about which the assistant sometimes ask a question : {user_healthissues}"""
+
+PROMPT_TEMPLATES = {"chat": CHAT_SYSTEM_PROMPT, "med_greeting": MED_GREETING_SYSTEM_PROMPT}
+
+
+# Prompt assembly of one session.
+# The static part (instructions + user information) is rendered once per session and always sent first,
+# so it is an identical prefix on every turn and the provider's prompt cache can reuse it.
+# What changes goes after it : the rolling summary, the recent turns, and the current time as the last message.
+class PromptBuilder:
+    def __init__(self, user_info):
+        self.user_info = user_info
+        self.static_prompts = {}    # kind -> (rendered system prompt, tokens)
+        self.builds = 0
+        self.last_build_ms = 0.0
+        self.last_prompt_tokens = 0
+        self.last_static_tokens = 0
+
+    def static_prompt(self, kind):
+        if kind not in self.static_prompts:
+            user_info = self.user_info
+            prompt = PROMPT_TEMPLATES[kind].format(
+                username=user_info['username'],
+                usersex=user_info['usersex'],
+                userage=user_info['userage'],
+                user_diseases=json.loads(user_info['disease']) if user_info['disease'] else [],
+                korea_medication_alarm=user_info['alarm_schedule'].korea_alarm_time['health_med_alarm'],
+                korea_injection_alarm=user_info['alarm_schedule'].korea_alarm_time['health_inj_alarm'],
+                user_healthissues=user_info['healthissue']
+            )
+            self.static_prompts[kind] = (prompt, count_tokens(prompt))
+        return self.static_prompts[kind]
+
+    # messages = [static system prompt] + [summary] + turns + [current time]
+    # turn_tokens : token count of turns when the caller already knows it (ConversationContext.window_tokens)
+    def build(self, kind, turns, current_time, summary=None, turn_tokens=None):
+        started = time.perf_counter()
+        prompt, static_tokens = self.static_prompt(kind)
+
+        messages = [{"role": "system", "content": prompt}]
+        tokens = static_tokens
+        if summary is not None:
+            summary_message = f"Summary of the earlier conversation:\n{summary if summary else 'None'}"
+            messages.append({"role": "system", "content": summary_message})
+            tokens += count_tokens(summary_message)
+        messages += turns
+        tokens += turn_tokens if turn_tokens is not None else sum(count_tokens(turn["content"]) for turn in turns)
+        time_message = f"Current time : {current_time}"
+        messages.append({"role": "system", "content": time_message})
+        tokens += count_tokens(time_message)
+
+        self.builds += 1
+        self.last_build_ms = (time.perf_counter() - started) * 1000
+        self.last_prompt_tokens = tokens
+        self.last_static_tokens = static_tokens
+        return messages
+
+    def stats(self):
+        return {"builds": self.builds,
+                "prompt_tokens": self.last_prompt_tokens,
+                "static_prefix_tokens": self.last_static_tokens,
+                "build_ms": round(self.last_build_ms, 3)}
+
+
+# Process-wide cache of user_info by phone_id, so reconnects do not run the profile JOIN again.
+# Entries are dropped by invalidate() whenever the profile changes : /adduser (through /internal/profile_invalidate),
+# phoneid_db_search_update and new summarization rows. Cached user_info dicts are shared and must not be modified.
+class ProfileCache:
+    def __init__(self, pool):
+        self.pool = pool
+        self.profiles = {}
+        self.lock = threading.Lock()
+        self.loading = {}      # phone_id -> lock, so that a reconnect storm loads a profile once
+        # generation of the cache and the generation each phone_id / username was last invalidated at,
+        # so a profile read from the database before an invalidation is not stored after it
+        self.generation = 0
+        self.invalidated_at = {}   # ("phone_id", phone_id) or ("username", username) -> generation
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, phone_id):
+        with self.lock:
+            if phone_id in self.profiles:
+                self.hits += 1
+                return self.profiles[phone_id]
+            loading = self.loading.setdefault(phone_id, threading.Lock())
+
+        with loading:
+            with self.lock:
+                if phone_id in self.profiles:
+                    self.hits += 1
+                    return self.profiles[phone_id]
+                self.misses += 1
+                loaded_at = self.generation
+
+            user_info = UserInfo(self.pool).get_user_info(phone_id)
+            with self.lock:
+                # unknown users are not cached, they may register at any time
+                if user_info is not None and not self._invalidated_since(loaded_at, phone_id, user_info["username"]):
+                    self.profiles[phone_id] = user_info
+                self.loading.pop(phone_id, None)
+            return user_info
+
+    # drop the cached profile of a phone_id and/or every profile of a username
+    def invalidate(self, phone_id=None, username=None):
+        with self.lock:
+            self.generation += 1
+            if phone_id is not None:
+                self.invalidated_at[("phone_id", phone_id)] = self.generation
+            if username is not None:
+                self.invalidated_at[("username", username)] = self.generation
+            for key in [key for key, info in self.profiles.items() if key == phone_id or (username is not None and info["username"] == username)]:
+                del self.profiles[key]
+                self.invalidations += 1
+
+    # called with self.lock held
+    def _invalidated_since(self, generation, phone_id, username):
+        return (self.invalidated_at.get(("phone_id", phone_id), 0) > generation
+                or self.invalidated_at.get(("username", username), 0) > generation)
+
+    def stats(self):
+        with self.lock:
+            return {"profiles": len(self.profiles), "hits": self.hits, "misses": self.misses, "invalidations": self.invalidations}
+
+
+profile_cache = ProfileCache(db_pool)
+
+
 # To prevent the mixing of user information that may occur when importing multiple users’ information simultaneously, 
 # it is necessary to manage user information by session. This can be achieved using the UserSession class.
 class UserSession:
     
-    def __init__(self, phone_id, data):
+    # now : reference time of the session (a future alarm time when the session is made to pre-generate a greeting)
+    def __init__(self, phone_id, data, now=None, pregeneration=False):
         self.phone_id = phone_id
         self.data = data
+        self.now = now if now is not None else datetime.now(timezone('Asia/Seoul'))
+        self.pregeneration = pregeneration
+        self.greeting = None
         self.time_delta = timedelta(minutes=3)
-        self.current_time = datetime.now(timezone('Asia/Seoul')).time()
+        self.current_time = self.now.time()
         self.close_time, self.close_key = self.check_times()
         self.session_id = self.generate_session_id()
         self.sessiontime = self.get_sessiontime()
         self.current_timearea = self.get_current_timearea()
         self.context_counter = 0
-        self.context = []
-        self.context_string = []
+        self.user_turns = 0
+        self.context = ConversationContext()
+        self.weather_grid = WEATHER_DEFAULT_GRID
+        self.prompt_builder = PromptBuilder(data)
 
     def generate_session_id(self):
-        current_time_str = datetime.now(timezone('Asia/Seoul')).strftime('%Y%m%d%H%M%S')
+        current_time_str = self.now.strftime('%Y%m%d%H%M%S')
         session_id = f"{current_time_str}_{self.phone_id}"
         return session_id
 
-    def is_within_time_range(self, target_time, reference_time, delta):
-        reference_datetime = datetime.combine(datetime.today(), reference_time)
-        target_datetime = datetime.combine(datetime.today(), target_time)
-        return abs(reference_datetime - target_datetime) <= delta
-    
-    def add_hours_to_time(self, time_obj, hours):
-        full_datetime = datetime.combine(datetime.today(), time_obj)
-        new_datetime = full_datetime + timedelta(hours=hours)
-        return new_datetime.time()
-
+    # alarm (korean time) within time_delta of the session time and its kind, using the compiled alarm schedule
     def check_times(self):
-        close_time = None
-        close_key = None
-        for key, value in self.data.items():
-            if isinstance(value, list):
-                for item in value:
-                    if isinstance(item, dict):
-                        for sub_key, times in item.items():
-                            for t in times:
-                                t_with_added_hours = self.add_hours_to_time(t, 9)
-                                if self.is_within_time_range(t_with_added_hours, self.current_time, self.time_delta):
-                                    close_time = t_with_added_hours
-                                    close_key = key
-                    elif isinstance(item, list):
-                        for t in item:
-                            t_with_added_hours = self.add_hours_to_time(t, 9)
-                            if self.is_within_time_range(t_with_added_hours, self.current_time, self.time_delta):
-                                close_time = t_with_added_hours
-                                close_key = key
-        return close_time, close_key
+        alarm_schedule = self.data.get("alarm_schedule")
+        if alarm_schedule is None:
+            return None, None
+        return alarm_schedule.find_close_alarm(self.current_time, self.time_delta)
 
     # get conversation sessiontime which will be saved in database to distinguish conversation session
     def get_sessiontime(self):
@@ -244,85 +631,201 @@ class UserSession:
         return current_timearea
 
 # %%
-def get_transcript(file_path): # Speech to Text
-    # Open the audio file in binary read mode
-    audio_file = open(file_path, "rb")
-    
-    # Use the OpenAI Whisper model to transcribe the audio
-    transcript = openai_client.audio.transcriptions.create(
-        model="whisper-1",           # Specifies the Whisper model to use
-        file=audio_file,             # Passes the audio file to the API
-        response_format="text"       # Requests the transcription in text format
-    )
+# speech to text backend : openai (whisper-1), local (faster-whisper on this machine) or auto (openai, local when it is slow or failing)
+stt_backend = create_stt_backend(
+    os.environ.get('ELF_STT_BACKEND', 'openai'),
+    openai_client,
+    local_model=os.environ.get('ELF_STT_LOCAL_MODEL', 'small'),
+    local_workers=int(os.environ.get('ELF_STT_LOCAL_WORKERS', '2')),
+    language=os.environ.get('ELF_STT_LANGUAGE') or None
+)
 
-    # Return the transcription
-    return transcript
+def get_transcript(audio_data): # Speech to Text from the raw 16kHz pcm of the app, no file needed
+    return stt_backend.transcribe(audio_data)
+
+# cuts the silence before and after the user's speech, before stt and storage
+vad_trimmer = VoiceActivityTrimmer(padding_ms=int(os.environ.get('ELF_VAD_PADDING_MS', '300')))
 
 # %%
 
-# insert conversation to context table in database
-def save_context_to_db(session, context_counter, user_info, role, created_time, content, conversation_start=None, conv_model=None):
+# This worker process : its id in the session store and its slot on this node (0 .. ELF_WORKERS-1).
+# The slot is held with a file lock while the process lives, so the journals of a slot are picked up again
+# by the worker that replaces a stopped one. Jobs that must run once per node only run in slot 0.
+# The slot is claimed when the app starts serving, not on import : the hypercorn parent and the copy of the
+# main script that multiprocessing runs in each worker also import this module.
+WORKER_ID = f"{platform.node()}:{os.getpid()}"
+
+def claim_worker_slot(lock_dir, max_slots=64):
+    if fcntl is None:
+        return 0, None
+    os.makedirs(lock_dir, exist_ok=True)
+    for slot in range(max_slots):
+        lock_file = open(os.path.join(lock_dir, f"worker_{slot}.lock"), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return slot, lock_file
+        except OSError:
+            lock_file.close()
+    raise RuntimeError(f"no free worker slot in {lock_dir}")
 
-    phone_id = session.phone_id
-    session_id = session.session_id
-    username = user_info['username']
+worker_slot, worker_slot_lock = None, None
 
-    try:
-        connection = pymysql.connect(**db_config)
-        cursor = connection.cursor()
+# per-worker file : the configured path in slot 0 (as with a single worker), name.{slot}.ext in the others
+def worker_file(path):
+    if worker_slot == 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{worker_slot}{ext}"
 
-        query = """
-            INSERT INTO context (session_id, unique_number, created_at, phone_id, username, conversation_start, model, role, content) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """
-        values = (session_id, context_counter, created_time, phone_id, username, conversation_start, conv_model, role, content)
+# %%
 
-        cursor.execute(query, values)
-        connection.commit()
+# Write-behind buffer of context rows.
+# Rows are appended to a local journal first (so a turn is never lost) and kept per session,
+# then each session's rows are written with one multi-row INSERT at the end of a turn or on disconnect.
+# If MySQL is unavailable the rows stay in the buffer and journal and are retried in the background.
+class ContextWriter:
+    insert_query = queries.INSERT_CONTEXT
+
+    def __init__(self, pool, journal_path):
+        self.pool = pool
+        self.journal_path = journal_path
+        self.lock = threading.Lock()        # guards pending rows and the journal
+        self.flush_locks = {}               # session_id -> lock of the flush of that session
+        self.pending = {}                   # session_id -> [(seq, row)]
+        self.seq = 0
+        self.rows_written = 0
+        self.batches = 0
+        self.failures = 0
+
+    def _append_journal(self, entry):
+        with open(self.journal_path, "a", encoding="utf-8") as journal:
+            journal.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    # reload rows that were journaled but never flushed (e.g. the server stopped while MySQL was down)
+    def load_journal(self):
+        rows = {}
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, encoding="utf-8") as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if entry["op"] == "row":
+                        rows[entry["seq"]] = tuple(entry["row"])
+                    else:
+                        for seq in entry["seqs"]:
+                            rows.pop(seq, None)
+
+        with self.lock:
+            for seq, row in sorted(rows.items()):
+                self.pending.setdefault(row[0], []).append((seq, row))
+                self.seq = max(self.seq, seq)
+        return len(rows)
+
+    def add(self, row):
+        with self.lock:
+            self.seq += 1
+            self._append_journal({"op": "row", "seq": self.seq, "row": row})
+            self.pending.setdefault(row[0], []).append((self.seq, row))
+
+    # write buffered rows of a session to the database, returns False if they are still pending.
+    # Flushes of one session run one at a time (a row is never inserted twice), flushes of different sessions in parallel,
+    # so a session that waits for MySQL does not hold up the others.
+    def flush(self, session_id):
+        while True:
+            with self.lock:
+                flush_lock = self.flush_locks.setdefault(session_id, threading.Lock())
+            with flush_lock:
+                with self.lock:
+                    if self.flush_locks.get(session_id) is not flush_lock:
+                        continue # retired by the flush that wrote the last rows of the session : take the current lock
+                    rows = list(self.pending.get(session_id, []))
+                    if not rows:
+                        self.flush_locks.pop(session_id, None)
+                        return True
+                return self._write(session_id, rows)
+
+    # called with the session's flush lock held
+    def _write(self, session_id, rows):
+        try:
+            with self.pool.connection() as connection, connection.cursor() as cursor:
+                cursor.executemany(self.insert_query, [row for _, row in rows])
+                # move the user's latest-session pointer in the same transaction
+                latest = rows[-1][1]
+                cursor.execute(queries.UPSERT_CONTEXT_STATE, (latest[3], latest[4], latest[0], latest[2]))
+                connection.commit()
+        except pymysql.Error as error:
+            print(f"Error while connecting to MySQL: {error} ({len(rows)} context rows kept in the journal)")
+            with self.lock:
+                self.failures += 1
+            return False
+
+        flushed = {seq for seq, _ in rows}
+        with self.lock:
+            remaining = [item for item in self.pending.get(session_id, []) if item[0] not in flushed]
+            if remaining:
+                self.pending[session_id] = remaining
+            else:
+                self.pending.pop(session_id, None)
+                self.flush_locks.pop(session_id, None)
 
-        print("Context saved to the database.")
+            if self.pending:
+                self._append_journal({"op": "flushed", "seqs": sorted(flushed)})
+            else:
+                # nothing is pending anymore, so the journal can start over
+                open(self.journal_path, "w").close()
 
-    except pymysql.Error as error:
-        print(f"Error while connecting to MySQL: {error}")
+            self.rows_written += len(rows)
+            self.batches += 1
+        print(f"Context saved to the database ({len(rows)} rows).")
+        return True
 
-    finally:
-        cursor.close()
-        connection.close()
+    def flush_all(self):
+        with self.lock:
+            session_ids = list(self.pending)
+        return all([self.flush(session_id) for session_id in session_ids])
 
-    # to save user speech audiofile and make name of the audiofiles
-    if role == "user":
-        userevenno = context_counter
-        return userevenno
+    def stats(self):
+        with self.lock:
+            pending_rows = sum(len(rows) for rows in self.pending.values())
+        return {"pending_rows": pending_rows, "rows_written": self.rows_written, "batches": self.batches, "failures": self.failures}
 
-# %%
-# save name of audiofile to context table in database
-def save_audiodir_to_context(session, audiodir):
-    session_id = session.session_id
-    userevenno = session.context_counter -1
-    
-    try:
-        
-        connection = pymysql.connect(**db_config)
-        cursor = connection.cursor()
 
-        
-        query = """UPDATE context
-                    SET audio_file_dir = %s
-                    WHERE session_id = %s AND unique_number = %s AND role = 'user';"""
-        values = (audiodir, session_id, userevenno)
+# the journal path is made per worker (worker_file) once the worker slot is claimed at startup
+context_writer = ContextWriter(db_pool, os.environ.get('ELF_CONTEXT_JOURNAL', './context_journal.jsonl'))
 
-        
-        cursor.execute(query, values)
-        connection.commit()
 
-        print("Audio directory saved to the database.")
+# write a session's rows at the end of a turn without making the session wait for the database
+# (rows that cannot be written stay in the journal and are retried by context_writer_retry)
+def flush_context_later(session_id):
+    blocking_executor.submit(context_writer.flush, session_id)
 
-    except pymysql.Error as error:
-        print(f"Error while connecting to MySQL: {error}")
 
-    finally:
-        cursor.close()
-        connection.close()
+# retry context rows that could not be written, e.g. while MySQL was restarting
+async def context_writer_retry(interval=30):
+    while True:
+        await asyncio.sleep(interval)
+        if context_writer.stats()["pending_rows"]:
+            await run_blocking(context_writer.flush_all)
+
+
+# insert conversation to context table in database (buffered by context_writer until the turn ends)
+def save_context_to_db(session, context_counter, user_info, role, created_time, content, conversation_start=None, conv_model=None, audio_file_dir=None):
+
+    phone_id = session.phone_id
+    session_id = session.session_id
+    username = user_info['username']
+
+    values = (session_id, context_counter, created_time, phone_id, username, conversation_start, conv_model, role, content, audio_file_dir)
+    context_writer.add(values)
+
+    # to save user speech audiofile and make name of the audiofiles
+    if role == "user":
+        userevenno = context_counter
+        return userevenno
 
 # %%
 
@@ -346,53 +849,39 @@ def adjust_times(alarm_time, hours):
     return korea_alarm_time
 
 
-# get medication alarm greeting message
-def med_regular_greeting(session, user_info):
-    context = session.context
+# keep greeting message in session context and save it in database.
+# Sessions made only to pre-generate a greeting (session.pregeneration) just remember how the greeting was made.
+def save_greeting(session, user_info, greeting_text, conversation_start, conv_model):
+    session.greeting = {"text": greeting_text, "conversation_start": conversation_start, "conv_model": conv_model}
+    if session.pregeneration:
+        return
 
-    korea_medication_alarm = adjust_times(user_info['health_med_alarm'], 9)
-    korea_injection_alarm = adjust_times(user_info['health_med_alarm'], 9)
+    greeting_time = datetime.now(timezone('Asia/Seoul')).strftime('%Y-%m-%d %H:%M:%S')
+    session.context.append({"role": "assistant", "content": greeting_text})
+    session.context_counter += 1  # Increment context_counter
+    context_counter = session.context_counter
+    save_context_to_db(session, context_counter, user_info, "assistant", greeting_time, greeting_text, conversation_start, conv_model)
 
-    prompt = f"""The assistant greets the user based on the given user info and user health information.
-              The assistant should talk to the elderly like a friendly neighbor.
-              The assistant uses casual and informal conversation style.
-              The assistant is talking to the elderly who wants to have friendly conversation. 
-              The assistant should not use difficult words or phrases, and should be patient and understanding.
-              The assistant speaks only English and is designed to help the elderly who can understand only english.
 
-                The assistant should greet the user based on the given user personal information and user health information.
-                if current time is within the user's medication time or injection time, the assistant should ask the user whether the user have a medicine or injection.
-                - User information 
-                    username : {user_info['username']}, user gender : {user_info['usersex']}, user age : {user_info['userage']}
-                - User health information :
-                    The user's illnesses or diseases : {json.loads(user_info['disease']) if user_info['disease'] else []}
-                    The medication that the user must take and the times the users need to take it, and assistant should ask the user whether the user have a medicine : {korea_medication_alarm}
-                    The injection medication that the user must inject themselves and the times the users need to take it, and the assistant should ask the user whether the user have an injection : {korea_injection_alarm}
-                    Current time : {session.sessiontime}
-                    If the current time is within 3 minutes of the user’s medication time or injection time, the assistant should briefly ask the user whether they have taken their medicine or injection, including a greeting message.
-                    The user's health issues about which the assistant sometimes ask a question : {user_info['healthissue']}"""
-        
-    userhiddengreeting = [{"role": "user", "content": "Hello!" }]
+# get medication alarm greeting message
+def med_regular_greeting(session, user_info):
 
+    userhiddengreeting = [{"role": "user", "content": "Hello!" }]
+    messages = session.prompt_builder.build("med_greeting", userhiddengreeting, session.sessiontime)
 
     greetingresponse = openai_client.chat.completions.create(
         model="gpt-4o",
-        messages=[{"role":"system", "content": prompt}] + userhiddengreeting,
+        messages=messages,
         max_tokens=1024,
         temperature=0.5,
         stop=["\n"]
     )
     
     response_text = greetingresponse.choices[0].message.content
-    greeting_time = datetime.now(timezone('Asia/Seoul')).strftime('%Y-%m-%d %H:%M:%S')
     conv_model = greetingresponse.model
     conversation_start = "med_regular_greeting"
 
-    context.append({"role": "assistant", "content": response_text})
-    session.context_counter += 1  # Increment context_counter
-    context_counter = session.context_counter
-    
-    save_context_to_db(session, context_counter, user_info, "assistant", greeting_time, response_text, conversation_start, conv_model)
+    save_greeting(session, user_info, response_text, conversation_start, conv_model)
 
     return response_text  
 
@@ -400,115 +889,188 @@ def med_regular_greeting(session, user_info):
 
 # select greeting message from summarization table, which is usually used for casual alarm time
 def get_greeting_from_summarization(session, user_info):
-    context = session.context
     phone_id = session.phone_id
-  
-    try:
-        
-        connection = pymysql.connect(**db_config)
-        cursor = connection.cursor()
-
-        # summarization 테이블에서 다음 질문을 가져오는 쿼리
-        query = """SELECT next_first_question FROM summarization 
-                    WHERE phone_id = %s AND session_id = (SELECT session_id
-                                                        FROM summarization WHERE phone_id = %s
-                                                        ORDER BY summ_created_at DESC
-                                                        LIMIT 1
-                                                        );"""
-        values = (phone_id, phone_id)
-        
+
+    # the latest next_first_question is already loaded with the user profile
+    if user_info.get("prev_next_first_question"):
+        first_question_from_summ = (user_info["prev_next_first_question"],)
+    else:
+        try:
         
-        cursor.execute(query, values)
-        first_question_from_summ = cursor.fetchone()
+            with db_pool.connection() as connection, connection.cursor() as cursor:
 
-        print("Selected next first question from summarization table.")
-        print(f"phone_id : {phone_id}\nfirst_question_from_summ : {first_question_from_summ}")
+                # summarization 테이블에서 다음 질문을 가져오는 쿼리
+                cursor.execute(queries.LATEST_NEXT_FIRST_QUESTION, (phone_id,))
+                first_question_from_summ = cursor.fetchone()
 
-    except pymysql.Error as error:
-        print(f"Error while connecting to MySQL: {error}")
+                print("Selected next first question from summarization table.")
+                print(f"phone_id : {phone_id}\nfirst_question_from_summ : {first_question_from_summ}")
+
+        except pymysql.Error as error:
+            print(f"Error while connecting to MySQL: {error}")
 
-    finally:
-        cursor.close()
-        connection.close()
         
     greetingresponse = "".join(first_question_from_summ)
     greeting_text = greetingresponse
-    greeting_time = datetime.now(timezone('Asia/Seoul')).strftime('%Y-%m-%d %H:%M:%S')
     conv_model = "summarization"
     conversation_start = "get_greeting_from_summarization"
 
-    context.append({"role": "assistant", "content": greeting_text})
-    session.context_counter += 1  # Increment context_counter
-    context_counter = session.context_counter
-
-    save_context_to_db(session, context_counter, user_info, "assistant", greeting_time, greeting_text, conversation_start, conv_model)
+    save_greeting(session, user_info, greeting_text, conversation_start, conv_model)
 
     return greeting_text
   
 
-# make greeting message for morning casual alarm, which inform Chuncheon's weather information
-def make_weather_greeting(session, user_info):
-    # global context
-    # global username
-    # global sessiontime
-    context = session.context
-  
-    temp_time = datetime.now(timezone('Asia/Seoul'))
-    mod_datetime = temp_time - timedelta(hours = 0.5)
-    input_date = mod_datetime.strftime('%Y%m%d%H%M')[:-4]
-    input_time = mod_datetime.strftime('%Y%m%d%H%M')[-4:]
-
-    # Chuncheon coordinate
-    nx = '73'
-    ny = '134'
-    
-    # serviceKey for weather api from 공공데이터포털(data.go.kr) 
-    serviceKey = "8SukIEKtVXQQ3NeKhumtUS3gof1NZbvkVyP6G6dzGAhc4kR8PHImAvQf3l5yadry8iDYX0MZf4MMvMIsm7hqoA%3D%3D"
+# %%
+# weather forecast cache for make_weather_greeting
 
-    # url
-    url = f"http://apis.data.go.kr/1360000/VilageFcstInfoService_2.0/getUltraSrtFcst?serviceKey={serviceKey}&numOfRows=60&pageNo=1&dataType=json&base_date={input_date}&base_time={input_time}&nx={nx}&ny={ny}"
+# serviceKey for weather api from 공공데이터포털(data.go.kr) 
+WEATHER_SERVICE_KEY = "8SukIEKtVXQQ3NeKhumtUS3gof1NZbvkVyP6G6dzGAhc4kR8PHImAvQf3l5yadry8iDYX0MZf4MMvMIsm7hqoA%3D%3D"
+WEATHER_URL = "http://apis.data.go.kr/1360000/VilageFcstInfoService_2.0/getUltraSrtFcst"
 
+# Chuncheon coordinate
+WEATHER_DEFAULT_GRID = ('73', '134')
 
-    response = requests.get(url, verify=False)
-    weather_result = json.loads(response.text)
 
-    weather_result_append = []
-    target_fcst_time = weather_result["response"]["body"]["items"]["item"][0]["fcstTime"]
+# The KMA ultra short-term forecast is issued every hour at HH:30 and can be fetched from about HH:45.
+# returns base_date, base_time of the latest available forecast and when the next one becomes available
+def get_forecast_base(now):
+    base = (now - timedelta(minutes=45)).replace(minute=30, second=0, microsecond=0)
+    expires_at = base + timedelta(hours=1, minutes=15)
+    return base.strftime('%Y%m%d'), base.strftime('%H%M'), expires_at
 
-    for item in weather_result["response"]["body"]["items"]["item"]:
-        if item["fcstTime"] == target_fcst_time:
-            weather_result_append.append(item)
 
-    mod_result = []
+# keep only the nearest forecast time of the api result as {category: value}
+def parse_ultra_short_forecast(weather_result):
+    items = weather_result["response"]["body"]["items"]["item"]
+    target_fcst_time = items[0]["fcstTime"]
 
     category_values = {}
-    for item in weather_result_append:
-        category_values[item['category']] = item['fcstValue']
-        base_data = {
-            'baseDate': item['baseDate'],
-            'baseTime': item['baseTime'],
-            'fcstDate': item['fcstDate'],
-            'fcstTime': item['fcstTime'],
-            'nx': item['nx'],
-            'ny': item['ny']
-        }
+    for item in items:
+        if item["fcstTime"] == target_fcst_time:
+            category_values[item['category']] = item['fcstValue']
+    return category_values
+
+
+# Forecasts shared by every user, keyed by (nx, ny, base_date, base_time) and valid until the next KMA release.
+# refresh() runs on the event loop with a pooled async http client and is kept warm by weather_prefetcher(),
+# get() is called from greeting code on worker threads and answers from memory.
+class WeatherForecastCache:
+    def __init__(self):
+        self.forecasts = {}   # (nx, ny, base_date, base_time) -> (category_values, expires_at)
+        self.latest = {}      # (nx, ny) -> newest key
+        self.inflight = {}    # key -> asyncio.Task, so that concurrent refreshes of one forecast share a request
+        self.client = None
+        self.loop = None
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.client = httpx.AsyncClient(
+            timeout=10.0,
+            verify=False,
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=4)
+        )
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+
+    async def _fetch(self, key, expires_at):
+        nx, ny, base_date, base_time = key
+        url = f"{WEATHER_URL}?serviceKey={WEATHER_SERVICE_KEY}&numOfRows=60&pageNo=1&dataType=json&base_date={base_date}&base_time={base_time}&nx={nx}&ny={ny}"
+        response = await self.client.get(url)
+        category_values = parse_ultra_short_forecast(response.json())
+        self.forecasts[key] = (category_values, expires_at)
+        self.latest[(nx, ny)] = key
+        # forecasts older than the newest one of the grid are no longer needed
+        for old_key in [k for k in self.forecasts if k[:2] == (nx, ny) and k != key]:
+            del self.forecasts[old_key]
+        print(f"Weather forecast cached : grid {nx},{ny} base {base_date} {base_time}")
+        return category_values
+
+    # make sure the latest forecast of a grid is cached
+    async def refresh(self, nx, ny):
+        base_date, base_time, expires_at = get_forecast_base(datetime.now(timezone('Asia/Seoul')))
+        key = (nx, ny, base_date, base_time)
+        if key in self.forecasts:
+            return self.forecasts[key][0]
+
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key, expires_at))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await task
+
+    # forecast of a grid for the greeting (called from worker threads)
+    # A forecast of the previous release is still used while the new one is being fetched in the background,
+    # only a grid that was never fetched waits for the api.
+    def get(self, nx, ny):
+        base_date, base_time, _ = get_forecast_base(datetime.now(timezone('Asia/Seoul')))
+        key = (nx, ny, base_date, base_time)
+        if key in self.forecasts:
+            self.hits += 1
+            return self.forecasts[key][0]
+
+        latest_key = self.latest.get((nx, ny))
+        if latest_key in self.forecasts:
+            self.stale_hits += 1
+            self.loop.call_soon_threadsafe(lambda: asyncio.ensure_future(self.refresh(nx, ny)))
+            return self.forecasts[latest_key][0]
+
+        self.misses += 1
+        return asyncio.run_coroutine_threadsafe(self.refresh(nx, ny), self.loop).result(timeout=15)
+
+    def stats(self):
+        return {"grids": len(self.latest), "hits": self.hits, "stale_hits": self.stale_hits, "misses": self.misses}
+
+
+weather_cache = WeatherForecastCache()
+
+
+# grids to keep warm : the default grid and the grids of connected users
+def get_active_weather_grids():
+    grids = {WEATHER_DEFAULT_GRID}
+    for session in list(manager.session.values()):
+        grids.add(session.weather_grid)
+    return grids
+
+
+# background task that refreshes forecasts right after each KMA release,
+# so morning greetings never wait for the government api
+async def weather_prefetcher():
+    while True:
+        retry = False
+        for nx, ny in get_active_weather_grids():
+            try:
+                await weather_cache.refresh(nx, ny)
+            except Exception as e:
+                print(f"Weather prefetch failed for grid {nx},{ny}: {e}")
+                retry = True
+
+        now = datetime.now(timezone('Asia/Seoul'))
+        _, _, expires_at = get_forecast_base(now)
+        wait = 60 if retry else min(max((expires_at - now).total_seconds(), 60), 600)
+        await asyncio.sleep(wait)
+
+
+# make greeting message for morning casual alarm, which inform Chuncheon's weather information
+def make_weather_greeting(session, user_info):
+    # global context
+    # global username
+    # global sessiontime
+
+    nx, ny = session.weather_grid
+    weather = weather_cache.get(nx, ny)
 
-    mod_result.append({
-        'baseDate': base_data['baseDate'],
-        'baseTime': base_data['baseTime'],
-        'category': category_values,
-        'fcstDate': base_data['fcstDate'],
-        'fcstTime': base_data['fcstTime'],
-        'nx': base_data['nx'],
-        'ny': base_data['ny']
-    })
-
-    lgt = mod_result[0]["category"]["LGT"]
-    pty = mod_result[0]["category"]["PTY"]
-    rn1 = mod_result[0]["category"]["RN1"]
-    sky = mod_result[0]["category"]["SKY"]
-    t1h = mod_result[0]["category"]["T1H"]
-    wsd = mod_result[0]["category"]["WSD"]
+    lgt = weather["LGT"]
+    pty = weather["PTY"]
+    rn1 = weather["RN1"]
+    sky = weather["SKY"]
+    t1h = weather["T1H"]
+    wsd = weather["WSD"]
 
     #   lgt, pty, rn1, sky, t1h, wsd = weather_info()
   
@@ -549,13 +1111,9 @@ def make_weather_greeting(session, user_info):
     )
 
     response_text = greetingresponse.choices[0].message.content
-    greeting_time = datetime.now(timezone('Asia/Seoul')).strftime('%Y-%m-%d %H:%M:%S')
     conv_model = greetingresponse.model
     conversation_start = "make_weather_greeting"
-    context.append({"role": "assistant", "content": response_text})
-    session.context_counter += 1  # Increment context_counter
-    context_counter = session.context_counter
-    save_context_to_db(session, context_counter, user_info, "assistant", greeting_time, response_text, conversation_start, conv_model)
+    save_greeting(session, user_info, response_text, conversation_start, conv_model)
 
 
     return response_text  
@@ -564,42 +1122,39 @@ def make_weather_greeting(session, user_info):
 
 # %%
 # summarization
-def get_previous_conversation(phone_id): # get previous conversation to summarize the conversation and then derive next greeting message from the summarization
+def get_previous_conversation(phone_id, session_id=None): # get previous conversation to summarize the conversation and then derive next greeting message from the summarization
+    previous_conversation = None
     try:
         
-        connection = pymysql.connect(**db_config)
-        cursor = connection.cursor()
-
-        # 방금 대화 내용 요약 쿼리
-        query = """SELECT session_id, conversation_start, role, content
-        FROM context
-        WHERE phone_id = %s AND session_id = (
-            SELECT session_id
-            FROM context WHERE phone_id = %s
-            ORDER BY created_at DESC
-            LIMIT 1
-        ) ORDER BY created_at ASC;"""
-        values = (phone_id, phone_id)
+        with db_pool.connection() as connection, connection.cursor() as cursor:
+
+            if session_id is not None:
+                # 지정된 세션의 대화 내용
+                query = queries.SESSION_CONVERSATION
+                values = (session_id,)
+            else:
+                # 방금 대화 내용 요약 쿼리
+                query = queries.LATEST_SESSION_CONVERSATION
+                values = (phone_id,)
 
         
-        cursor.execute(query, values)
-        previous_conversation = cursor.fetchall()
+            cursor.execute(query, values)
+            previous_conversation = cursor.fetchall()
 
-        print("Previous conversation retrieved from the database.")
+            print("Previous conversation retrieved from the database.")
 
     except pymysql.Error as error:
         print(f"Error while connecting to MySQL: {error}")
 
-    finally:
-        cursor.close()
-        connection.close()
     
     return previous_conversation
 
-def make_summ_nextgreeting_from_chat(session, user_info): # make summarization and nextgreeting from chat using chatgpt(gpt-4o)
+def make_summ_nextgreeting_from_chat(session, user_info, session_id=None): # make summarization and nextgreeting from chat using chatgpt(gpt-4o)
     # global username
     phone_id = session.phone_id
-    previous_conversation = get_previous_conversation(phone_id)
+    previous_conversation = get_previous_conversation(phone_id, session_id)
+    if previous_conversation is not None and len(previous_conversation) == 0:
+        return None # the session has no context rows : nothing to summarize
     conversation_start = previous_conversation[0][1]
     current_time_summ = datetime.now(timezone('Asia/Seoul')).strftime('%Y-%m-%d %H:%M:%S')
     conv_session_id = previous_conversation[0][0]
@@ -683,31 +1238,164 @@ def make_summ_nextgreeting_from_chat(session, user_info): # make summarization a
 
 
 # insert summarization information into summarization table
-def save_summarization_to_db(session, user_info):
+# (returns False when it could not be saved, None when the session has no conversation to summarize)
+def save_summarization_to_db(session, user_info, session_id=None):
     phone_id = session.phone_id
     username = user_info["username"]
-    response_sum_text, response_greeting_text, current_time_summ, conv_session_id, summ_model, conversation_start = make_summ_nextgreeting_from_chat(session, user_info)
+    summary = make_summ_nextgreeting_from_chat(session, user_info, session_id)
+    if summary is None:
+        return None
+    response_sum_text, response_greeting_text, current_time_summ, conv_session_id, summ_model, conversation_start = summary
     #mix
     try:
         
-        connection = pymysql.connect(**db_config)
-        cursor = connection.cursor()
+        with db_pool.connection() as connection, connection.cursor() as cursor:
 
-        query = "INSERT INTO summarization (session_id, summ_created_at, phone_id, username, conversation_start, summary_model, summary, next_first_question) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
-        values = (conv_session_id, current_time_summ, phone_id, username, conversation_start, summ_model, response_sum_text, response_greeting_text)
+            query = queries.INSERT_SUMMARIZATION
+            values = (conv_session_id, current_time_summ, phone_id, username, conversation_start, summ_model, response_sum_text, response_greeting_text)
 
         
-        cursor.execute(query, values)
-        connection.commit()
+            cursor.execute(query, values)
+            cursor.execute(queries.UPSERT_SUMMARY_STATE, (phone_id, username, conv_session_id, conversation_start, response_sum_text, response_greeting_text, current_time_summ))
+            connection.commit()
 
-        print("Summarization and next greeting saved to the database.")
+            print("Summarization and next greeting saved to the database.")
 
     except pymysql.Error as error:
         print(f"Error while connecting to MySQL: {error}")
+        return False
+
+    # the profile holds the latest summary and next greeting
+    invalidate_profile_everywhere(phone_id)
+    return True
+
+
+# Summarization of finished sessions, run by background workers instead of the socket handler.
+# - a session is queued at most once (deduplicated by session_id) and only if the user said something
+# - at most `concurrency` summarizations run at the same time
+# - a job waits until the session's context rows are in the database (they may still be in the context journal),
+#   and failures are retried with a backoff capped at max_retry_delay : a summary is never dropped by an outage
+# - a session without any context rows in the database is done without a summary (retrying would never help)
+# - queued jobs are journaled to a file, so jobs left when the server stops are run again at startup
+class SummarizationQueue:
+    def __init__(self, journal_path, concurrency=2, retry_delay=30, max_retry_delay=600):
+        self.journal_path = journal_path
+        self.concurrency = concurrency
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.queue = None
+        self.jobs = {}          # session_id -> job, queued or running
+        self.workers = []
+        self.done = 0
+        self.failed = 0         # failed attempts (retried)
+        self.waiting = 0        # times a job waited for its context rows
+        self.empty = 0          # sessions done without a summary (no context rows)
+        self.skipped = 0
+        self.deduplicated = 0
+
+    def _append_journal(self, entry):
+        with open(self.journal_path, "a", encoding="utf-8") as journal:
+            journal.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    # jobs that were added but never finished, and rewrite the journal with only those
+    def _load_pending_jobs(self):
+        pending = {}
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, encoding="utf-8") as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if entry["op"] == "add":
+                        pending[entry["job"]["session_id"]] = entry["job"]
+                    else:
+                        pending.pop(entry["session_id"], None)
+
+        temp_path = f"{self.journal_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as journal:
+            for job in pending.values():
+                journal.write(json.dumps({"op": "add", "job": job}, ensure_ascii=False) + "\n")
+        os.replace(temp_path, self.journal_path)
+        return list(pending.values())
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        for job in await run_blocking(self._load_pending_jobs):
+            self.jobs[job["session_id"]] = job
+            self.queue.put_nowait(job)
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+
+    # queue summarization of a finished session, returns immediately
+    async def submit(self, session, user_info):
+        if session is None or user_info is None or session.user_turns == 0:
+            self.skipped += 1
+            return False
+        if session.session_id in self.jobs:
+            self.deduplicated += 1
+            return False
+
+        job = {"session_id": session.session_id, "phone_id": session.phone_id, "username": user_info["username"], "attempts": 0}
+        self.jobs[job["session_id"]] = job
+        await run_blocking(self._append_journal, {"op": "add", "job": job})
+        self.queue.put_nowait(job)
+        return True
+
+    def _summarize(self, job):
+        session = UserSession(job["phone_id"], {})
+        return save_summarization_to_db(session, {"username": job["username"]}, job["session_id"])
+
+    async def _retry_later(self, job, delay):
+        await asyncio.sleep(delay)
+        self.queue.put_nowait(job)
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+
+            # the summary is made from the rows in the database : wait for rows still in the context journal
+            if not await run_blocking(context_writer.flush, job["session_id"]):
+                self.waiting += 1
+                asyncio.create_task(self._retry_later(job, self.retry_delay))
+                continue
+
+            try:
+                saved = await run_blocking(self._summarize, job)
+            except Exception as e:
+                print(f"Summarization failed for {job['session_id']}: {e}")
+                saved = False
+
+            if saved is None:
+                self.empty += 1
+                print(f"Summarization skipped for {job['session_id']}: no conversation in the database")
+            elif not saved:
+                self.failed += 1
+                job["attempts"] += 1
+                delay = min(self.retry_delay * 2 ** (job["attempts"] - 1), self.max_retry_delay)
+                asyncio.create_task(self._retry_later(job, delay))
+                continue
+
+            self.done += 1
+            del self.jobs[job["session_id"]]
+            await run_blocking(self._append_journal, {"op": "done", "session_id": job["session_id"]})
+
+    def stats(self):
+        return {"queued": self.queue.qsize() if self.queue else 0, "in_progress": len(self.jobs),
+                "done": self.done, "failed_attempts": self.failed, "waited_for_context": self.waiting, "empty": self.empty,
+                "skipped": self.skipped, "deduplicated": self.deduplicated}
+
+
+summarization_queue = SummarizationQueue(
+    os.environ.get('ELF_SUMMARY_JOURNAL', './summarization_queue.jsonl'),
+    concurrency=int(os.environ.get('ELF_SUMMARY_WORKERS', '2'))
+)
 
-    finally:
-        cursor.close()
-        connection.close()
 
 
 
@@ -716,7 +1404,6 @@ def save_summarization_to_db(session, user_info):
 # function to decide which greeting message for casual alarm should be derived according to situation and timearea
 def casual_greeting(session, user_info, casual_situation):
     # global context
-    context = session.context
     
     if casual_situation == 'morning':
         response = make_weather_greeting(session, user_info)
@@ -725,13 +1412,9 @@ def casual_greeting(session, user_info, casual_situation):
     elif casual_situation == 'evening':
         _, response_greeting, *_ = make_summ_nextgreeting_from_chat(session, user_info) #mix
         response = response_greeting
-        greeting_time = datetime.now(timezone('Asia/Seoul')).strftime('%Y-%m-%d %H:%M:%S') 
         conv_model = "script and summarization"
         conversation_start = "casual_greeting"
-        context.append({"role": "assistant", "content": response})
-        session.context_counter += 1  # Increment context_counter
-        context_counter = session.context_counter
-        save_context_to_db(session, context_counter, user_info, "assistant", greeting_time, response, conversation_start, conv_model)
+        save_greeting(session, user_info, response, conversation_start, conv_model)
     return response
 
 # get medication reminding greeting for mecication reminding alarm 
@@ -739,7 +1422,6 @@ def med_reminding_greeting(session, user_info):
     # global context
     # global username
     # global current_timearea
-    context = session.context
     username = user_info['username']
     current_timearea = session.current_timearea
     
@@ -752,14 +1434,10 @@ def med_reminding_greeting(session, user_info):
         prev_current_timearea = '어제'
 
     response = "Dear {username}, I was worried because you didn’t answer my call {prev_current_timearea}. Did you take your medication {prev_current_timearea}?"
-    greeting_time = datetime.now(timezone('Asia/Seoul')).strftime('%Y-%m-%d %H:%M:%S') 
     conv_model = "scripted"
     conversation_start = "med_reminding_greeting"
     
-    context.append({"role": "assistant", "content": response})
-    session.context_counter += 1
-    context_counter = session.context_counter
-    save_context_to_db(session, context_counter, user_info, "assistant", greeting_time, response, conversation_start, conv_model)
+    save_greeting(session, user_info, response, conversation_start, conv_model)
     
     return response
 
@@ -791,7 +1469,7 @@ def get_greeting_response(session, user_info):
     if session_close_key == 'casual':
         if prev_summary == 0 :
             if prev_conversation_start == 'med_regular_greeting':
-                resposne = med_reminding_greeting(session, user_info)
+                response = med_reminding_greeting(session, user_info)
             else:
                 response = get_casual_greeting(session, user_info)
         else:
@@ -807,82 +1485,70 @@ def get_greeting_response(session, user_info):
 # %%
 
 
-# chat with gpt and save context in memory and in database
-def chat_with_gpt(session, user_info, user_input, created_time):
+# build chat prompt and messages, and save user input in memory and in database
+def prepare_chat_messages(session, user_info, user_input, created_time, audio_file_dir=None):
 
     context = session.context
-    context_string = session.context_string
-    username = user_info['username']
-    usersex = user_info['usersex']
-    userage = user_info['userage']
-    user_diseases = json.loads(user_info['disease']) if user_info['disease'] else []
-    medication_alarm = user_info['health_med_alarm']
-    injection_alarm = user_info['health_inj_alarm']
-    user_healthissues = user_info['healthissue']
 
+    save_user_input(session, user_info, user_input, created_time, audio_file_dir)
 
-    temp_currenttime = datetime.now(timezone('Asia/Seoul')).time()
-    
+    # only the recent turns within the token budget are sent, older ones are in the summary
+    temp_currenttime = datetime.now(timezone('Asia/Seoul')).strftime('%H:%M')
+    messages = session.prompt_builder.build("chat", context.window(), temp_currenttime,
+                                            summary=context.summary, turn_tokens=context.window_tokens())
+    stats = session.prompt_builder.stats()
+    print(f"prompt tokens : {stats['prompt_tokens']} (static prefix {stats['static_prefix_tokens']}, "
+          f"window {len(messages) - 3} of {len(context)} turns, built in {stats['build_ms']:.2f} ms)")
 
-    # Iterate over each dictionary in the context list
-    for i, entry in enumerate(context):
-        # Format the string as 'role:content\n' (add '\n' if not the last item)
-        if i < len(context) - 1:
-            formatted_string = f"{entry['role']}:{entry['content']}\n"
-        else:
-            formatted_string = f"{entry['role']}:{entry['content']}"
-        
-        # Append the formatted string to the context_string list
-        context_string.append(formatted_string)
-    
-    korea_medication_alarm = adjust_times(medication_alarm, 9)
-    korea_injection_alarm = adjust_times(injection_alarm, 9)
-    
-    prompt = f"""The following is a friendly conversation between a human and an assistant.
-                The assistant should talk to the elderly like a friendly neighbor.
-                The assistant uses casual and informal conversation style.
-                The assistant cares about the health, daily life, and family of the elderly.    
-                The assistant is talking to the elderly who wants to have friendly conversation. 
-                The assistant is to help the elderly relieve their depression or gloomy mood by having a conversation. 
-                The assistant should not use difficult words or phrases, and should be patient and understanding.
-                The assistant should give a question to the elderly to keep the conversation going.
-                The assistant speaks only English and is designed to help the elderly who can understand only english.
-                
-                The assistant must respond "shortly" with no more than three sentences each time.
-                Remember to keep the conversation friendly and casual like a chat buddy.
-                Below is friendly and casual statement for the assistant to use.
-                ex) Oh, I heard your knee’s been bothering you and you haven’t been able to exercise. 
-                    My grandma went through the same thing. But don’t give up! Try doing some light exercises like swimming or stretching. If you keep at it, you’ll get stronger and it won’t hurt as much. You can do it, seriously. Go for it!
+    return messages
 
-                The assistant should understand and internalize the given user information and engage in conversation with the user based on this information.
-                User information = username : {username}, user gdnder : {usersex}, user age : {userage}
-                
-                - User health information that the assistant can reference during the conversation:
-                The user's illnesses or diseases : {user_diseases}
-                The user's medication the user needs to take and the times they need to take it : {korea_medication_alarm}
-                The user's injection medication the user needs to take and the times they need to take it: {korea_injection_alarm}
-                Current time : {temp_currenttime}
-                The user's other healthissues : {user_healthissues}
-                
-                
-                Previous conversation:\n{context_string}\n\nuser: {user_input}\nassistant:"""
 
-    context.append({"role": "user", "content": user_input})
+# save user input in memory and in database
+def save_user_input(session, user_info, user_input, created_time, audio_file_dir=None):
+    session.context.append({"role": "user", "content": user_input})
+    session.user_turns += 1
     session.context_counter += 1  # Increment context_counter
     context_counter = session.context_counter
-    save_context_to_db(session, context_counter, user_info, "user", created_time, user_input)
-    
-    response = openai_client.chat.completions.create(
+    save_context_to_db(session, context_counter, user_info, "user", created_time, user_input, audio_file_dir=audio_file_dir)
+
+
+# summarize turns that fell out of the prompt window, together with the previous rolling summary
+def summarize_older_turns(summary, turns):
+    conversation = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+
+    prompt_sum = """you have to update the summary of an ongoing conversation between the elderly user and the assistant.
+                    The summary is consisted of only english.
+                    The summary should be short and concise, and keep facts about the user's health, mood, daily life and family."""
+
+    request_summarization = f"""Update the summary with the conversation given below
+                            
+                            current summary:
+                            {summary if summary else "None"}
+                            
+                            conversation to add:
+                            {conversation}"""
+
+    response_sum = openai_client.chat.completions.create(
         model="gpt-4o",
-        messages=[{"role":"system", "content": prompt}] + context,
-        max_tokens=1024,
-        temperature=0.5,
-        stop=["\n"]
+        messages=[{"role":"system", "content": prompt_sum}, {"role": "user", "content": request_summarization}],
+        max_tokens=512,
+        temperature=0.5
     )
-    
-    response_text = response.choices[0].message.content
+    return response_sum.choices[0].message.content
+
+
+# compaction of a session's context, run on blocking_executor off the path of the user's next turn
+def compact_context(context):
+    try:
+        context.compact(summarize_older_turns)
+    except Exception as e:
+        print(f"Context compaction failed: {e}")
+
+
+# save chatgpt answer in memory and in database
+def save_chat_response(session, user_info, response_text, conv_model):
+    context = session.context
     response_time = datetime.now(timezone('Asia/Seoul')).strftime('%Y-%m-%d %H:%M:%S') 
-    conv_model = response.model
     
     context.append({"role": "assistant", "content": response_text})
     session.context_counter += 1  # Increment context_counter
@@ -890,27 +1556,218 @@ def chat_with_gpt(session, user_info, user_input, created_time):
     
     conversation_start = None
     save_context_to_db(session, context_counter, user_info, "assistant", response_time, response_text, conversation_start, conv_model)
+
+
+# chat with gpt and save context in memory and in database
+def chat_with_gpt(session, user_info, user_input, created_time, audio_file_dir=None):
+    messages = prepare_chat_messages(session, user_info, user_input, created_time, audio_file_dir)
+    
+    response = openai_client.chat.completions.create(
+        model="gpt-4o",
+        messages=messages,
+        max_tokens=1024,
+        temperature=0.5,
+        stop=["\n"]
+    )
+    
+    response_text = response.choices[0].message.content
+    save_chat_response(session, user_info, response_text, response.model)
  
     return response_text
 
 
+# sentence boundary : end punctuation (optionally followed by a closing quote) and whitespace
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+|(?<=[.!?]["\')])\s+')
+# very short sentences ("Oh!") are merged into the next one to avoid tiny tts requests
+MIN_TTS_SENTENCE_LENGTH = 20
+
+# chat with gpt using token streaming, yield the answer sentence by sentence as soon as each sentence is complete.
+# The full answer is saved in memory and in database after the last sentence.
+def iter_chat_with_gpt_sentences(session, user_info, user_input, created_time, audio_file_dir=None):
+    messages = prepare_chat_messages(session, user_info, user_input, created_time, audio_file_dir)
+
+    stream = openai_client.chat.completions.create(
+        model="gpt-4o",
+        messages=messages,
+        max_tokens=1024,
+        temperature=0.5,
+        stop=["\n"],
+        stream=True
+    )
+
+    response_parts = []
+    conv_model = None
+    pending = "" # unfinished tail of the answer
+    held = ""    # complete sentences that are still too short to send to tts
+    with stream:
+        for chunk in stream:
+            conv_model = conv_model or chunk.model
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            token = chunk.choices[0].delta.content
+            response_parts.append(token)
+            pending += token
+
+            # flush every complete sentence except the unfinished tail
+            pieces = SENTENCE_END.split(pending)
+            ready, pending = pieces[:-1], pieces[-1]
+            for piece in ready:
+                held = f"{held} {piece}" if held else piece
+                if len(held) >= MIN_TTS_SENTENCE_LENGTH:
+                    yield held
+                    held = ""
+
+    last_sentence = f"{held} {pending}".strip()
+    if last_sentence:
+        yield last_sentence
+
+    response_text = "".join(response_parts)
+    save_chat_response(session, user_info, response_text, conv_model)
+
+
 
 # %%
 
-# play chatgpt resposne with tts (return audiofile)
-def play_chatgpt_response_with_tts(ai_response, file_path):
-    # Generate speech from the GPT response using TTS
+# tts settings of every answer and greeting
+TTS_MODEL = "tts-1-hd"
+TTS_VOICE = "nova"
+TTS_SPEED = 0.92
+
+# audio format of streamed tts : raw 16-bit little-endian mono pcm at 24kHz (OpenAI "pcm" format)
+TTS_STREAM_FORMAT = "pcm_s16le"
+TTS_STREAM_SAMPLE_RATE = 24000
+TTS_STREAM_CHUNK_SIZE = 8192
 
+# synthesized audio by (text, model, voice, speed, format); every reply path shares the pcm entries
+tts_cache = TTSCache(
+    os.environ.get('ELF_TTS_CACHE_DIR', './tts_cache'),
+    max_bytes=int(os.environ.get('ELF_TTS_CACHE_MB', '512')) * 1024 * 1024
+)
+
+def tts_cache_key(text):
+    return TTSCache.make_key(text, TTS_MODEL, TTS_VOICE, TTS_SPEED, "pcm")
+
+# time-to-first-audio per reply type, measured from the start of the turn to the first audio sent to the app
+ttfa_metrics = {}
+
+def record_ttfa(name, seconds):
+    metric = ttfa_metrics.setdefault(name, {"count": 0, "last_ms": None, "avg_ms": 0.0, "max_ms": 0.0})
+    metric["count"] += 1
+    metric["last_ms"] = seconds * 1000
+    metric["avg_ms"] += (seconds * 1000 - metric["avg_ms"]) / metric["count"]
+    metric["max_ms"] = max(metric["max_ms"], seconds * 1000)
+    print(f"{name} time-to-first-audio : {seconds * 1000:.0f} ms")
+
+# stream chatgpt response with tts chunk by chunk without writing a temporary file
+def iter_chatgpt_response_tts(ai_response):
     with openai_client.audio.speech.with_streaming_response.create(
-        model="tts-1-hd",
-        voice="nova",
+        model=TTS_MODEL,
+        voice=TTS_VOICE,
         input=ai_response,
-        response_format="wav",
-        speed=0.92
+        response_format="pcm",
+        speed=TTS_SPEED
     ) as response:
-        response.stream_to_file(file_path)
-    
-    return response
+        for chunk in response.iter_bytes(TTS_STREAM_CHUNK_SIZE):
+            yield chunk
+
+# synthesize the whole tts audio of a text as raw pcm (TTS_STREAM_FORMAT), through the tts cache
+def synthesize_tts_pcm(text):
+    return tts_cache.get_or_create(tts_cache_key(text), lambda: b"".join(iter_chatgpt_response_tts(text)))
+
+# wrap raw tts pcm into a wav file for apps that receive the whole audio at once
+def pcm_to_wav(pcm, sample_rate=TTS_STREAM_SAMPLE_RATE):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm)
+    return buffer.getvalue()
+
+# play chatgpt response with tts (return wav audio)
+def synthesize_tts_wav(text):
+    return pcm_to_wav(synthesize_tts_pcm(text))
+
+# tts audio chunks of one text: from the cache, or streamed from OpenAI and cached once complete.
+# The same text requested by several sessions at once (e.g. a scripted greeting at an alarm time) is synthesized once :
+# the first one streams it, the others wait for the cached result.
+async def iter_tts_chunks(text):
+    key = tts_cache_key(text)
+    audio = await run_blocking(tts_cache.get, key)
+    leader = False
+    if audio is None:
+        in_flight = tts_cache.begin(key)
+        leader = in_flight is None
+        if not leader:
+            try:
+                # shield : a cancelled follower must not cancel the result the others wait for
+                audio = await asyncio.shield(asyncio.wrap_future(in_flight))
+            except Exception:
+                tts_cache.record_miss() # the leader was interrupted or failed : synthesize here
+    if audio is not None:
+        for start in range(0, len(audio), TTS_STREAM_CHUNK_SIZE):
+            yield audio[start:start + TTS_STREAM_CHUNK_SIZE]
+        return
+
+    parts = []
+    try:
+        async with aclosing(iterate_blocking(iter_chatgpt_response_tts, text)) as chunks:
+            async for chunk in chunks:
+                parts.append(chunk)
+                yield chunk
+    except BaseException: # also GeneratorExit / CancelledError of an interrupted stream, which is never cached
+        if leader:
+            tts_cache.abandon(key)
+        raise
+    # run to completion even if this task is cancelled now, so the waiting requests are always released
+    await run_blocking_to_completion(tts_cache.finish if leader else tts_cache.put, key, b"".join(parts))
+
+async def _single_text(text):
+    yield text
+
+# forward tts audio to the app as soon as each chunk arrives.
+# text is either a whole answer or an async iterator of sentences, which are synthesized in order into one stream.
+#   {command}_stream#start#pcm_s16le#24000 -> {command}_chunk#<pcm> ... -> {command}_stream#end
+async def stream_tts_to_client(text, command, phone_id, started=None):
+    started = started if started is not None else time.perf_counter()
+    texts = _single_text(text) if isinstance(text, str) else text
+    await manager.send_message(f"{command}_stream#start#{TTS_STREAM_FORMAT}#{TTS_STREAM_SAMPLE_RATE}", phone_id)
+
+    first_chunk = True
+    try:
+        # aclosing : when the stream is cancelled, the llm and tts streams are closed right away, not by the garbage collector
+        async with aclosing(texts):
+            async for sentence in texts:
+                async with aclosing(iter_tts_chunks(sentence)) as chunks:
+                    async for chunk in chunks:
+                        if first_chunk:
+                            record_ttfa(f"{command}_stream", time.perf_counter() - started)
+                            first_chunk = False
+                        await manager.send_audio(f"{command}_chunk", phone_id, chunk)
+    except asyncio.CancelledError:
+        # interrupted by the user (barge-in) : the app still gets the end of the stream it is playing
+        await manager.send_message(f"{command}_stream#end", phone_id)
+        raise
+
+    await manager.send_message(f"{command}_stream#end", phone_id)
+
+# %%
+# binary websocket frame for audio (human_cvs, welcome_tts, ai_cvs and their stream chunks)
+#   [2 bytes big-endian header length][utf-8 header "command#phone_id"][raw audio bytes]
+AUDIO_FRAME_HEADER = struct.Struct(">H")
+
+def pack_audio_frame(command, phone_id, audio):
+    header = f"{command}#{phone_id}".encode("utf-8")
+    return AUDIO_FRAME_HEADER.pack(len(header)) + header + audio
+
+# returns command, phone_id and the audio payload as a memoryview (no copy of the audio)
+def unpack_audio_frame(frame):
+    view = memoryview(frame)
+    (header_len,) = AUDIO_FRAME_HEADER.unpack_from(view)
+    header_end = AUDIO_FRAME_HEADER.size + header_len
+    header = bytes(view[AUDIO_FRAME_HEADER.size:header_end]).decode("utf-8")
+    command, _, phone_id = header.partition("#")
+    return command, phone_id, view[header_end:]
 
 # %%
 # save audio file(.wav) 
@@ -921,128 +1778,207 @@ def save_wav(buffer, file_path):
         wav_file.setframerate(16000)
         wav_file.writeframes(buffer)
 
-# rename wav file to distinquish conversation order using userevenno
-def rename_wav_file(session):
-    session_id = session.session_id
-    userevenno = session.context_counter-1
-    
-    humancvs_file_path = f"./useraudiofile/{session_id}_.wav"
-    
-    new_file_path = f"./useraudiofile/{session_id}_{userevenno:04d}.wav"
-    
+# path of the user's speech audiofile, named by the context number of the user turn
+def get_user_audio_path(session, unique_number):
+    return f"./useraudiofile/{session.session_id}_{unique_number:04d}.wav"
+
+# finished wavs are transcoded to opus (or flac) and moved to date / user shards, see audio_archive.py
+audio_archiver = AudioArchiver(
+    db_pool,
+    archive_format=os.environ.get('ELF_AUDIO_ARCHIVE_FORMAT', 'opus'),
+    workers=int(os.environ.get('ELF_AUDIO_ARCHIVE_WORKERS', '1'))
+)
+
+async def audio_archive_loop(interval=600):
+    while True:
+        await asyncio.sleep(interval)
+        await run_blocking(audio_archiver.archive_pending)
+
+# %%
+# greetings and their audio pre-generated a few minutes before each user's alarm
+
+# send pre-synthesized pcm with the same stream messages as stream_tts_to_client
+async def send_pcm_to_client(pcm, command, phone_id, started=None):
+    started = started if started is not None else time.perf_counter()
+    await manager.send_message(f"{command}_stream#start#{TTS_STREAM_FORMAT}#{TTS_STREAM_SAMPLE_RATE}", phone_id)
+    for offset in range(0, len(pcm), TTS_STREAM_CHUNK_SIZE):
+        if offset == 0:
+            record_ttfa(f"{command}_pregenerated", time.perf_counter() - started)
+        await manager.send_audio(f"{command}_chunk", phone_id, pcm[offset:offset + TTS_STREAM_CHUNK_SIZE])
+    await manager.send_message(f"{command}_stream#end", phone_id)
+
+# phone_id of every user who has alarms
+def get_alarm_phone_ids():
     try:
-        os.rename(humancvs_file_path, new_file_path)
-        print(f"File renamed from {humancvs_file_path} to {new_file_path}")
-    except FileNotFoundError:
-        print(f"File {humancvs_file_path} not found.")
-    except Exception as e:
-        print(f"Error renaming file: {e}")
-    
-    return new_file_path
+        with db_pool.connection() as connection, connection.cursor() as cursor:
+            cursor.execute(queries.ALARM_PHONE_IDS)
+            phone_ids = [row[0] for row in cursor.fetchall()]
+
+    except pymysql.Error as error:
+        print(f"Error while connecting to MySQL: {error}")
+        phone_ids = []
+
+    return phone_ids
+
+
+# Every minute, the greeting of each alarm that rings within lead_minutes (from alarm_timetable) is generated
+# with get_greeting_response on a session dated at the alarm time, synthesized with tts, and kept by (phone_id, alarm kind, alarm time)
+# in the session store, so the worker that gets the welcome_tts of the user can take it (the audio comes back from the tts cache).
+# welcome_tts takes it from the store and only generates a greeting live on a miss.
+class GreetingPregenerator:
+    def __init__(self, lead_minutes=5, user_refresh_minutes=10, concurrency=4, keep_minutes=30):
+        self.lead = timedelta(minutes=lead_minutes)
+        self.user_refresh = timedelta(minutes=user_refresh_minutes)
+        self.keep = timedelta(minutes=keep_minutes)
+        self.concurrency = concurrency
+        self.stored = {}         # (phone_id, alarm kind, "HH:MM") -> expiry of the entry put in the session store
+        self.pending = set()
+        self.user_infos = {}
+        self.user_infos_loaded_at = None
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.failed = 0
+
+    # the alarm slot a session belongs to, None if the session is not close to any alarm
+    @staticmethod
+    def slot_key(session):
+        if session.close_key is None:
+            return None
+        return (session.phone_id, session.close_key, session.close_time.strftime('%H:%M'))
+
+    @staticmethod
+    def store_key(key):
+        return "greeting:" + ":".join(str(part) for part in key)
+
+    def load_user_infos(self):
+        user_infos = {}
+        for phone_id in get_alarm_phone_ids():
+            user_info = profile_cache.get(phone_id)
+            if user_info is not None:
+                user_infos[phone_id] = user_info
+        return user_infos
+
+    # greeting text and audio of the alarm slot of a pre-generation session
+    def generate(self, session, user_info):
+        greeting_text = get_greeting_response(session, user_info)
+        synthesize_tts_pcm(greeting_text)   # the audio is kept in the tts cache
+        return dict(session.greeting, text=greeting_text)
+
+    async def _generate_slot(self, key, session, user_info, semaphore):
+        try:
+            async with semaphore:
+                entry = await run_blocking(self.generate, session, user_info)
+            expires_at = session.now + self.keep
+            ttl = (expires_at - datetime.now(timezone('Asia/Seoul'))).total_seconds()
+            await session_store.put_shared(self.store_key(key), entry, ttl)
+            self.stored[key] = expires_at
+            self.generated += 1
+            print(f"Greeting pre-generated for {key}")
+        except Exception as e:
+            self.failed += 1
+            print(f"Greeting pre-generation failed for {key}: {e}")
+        finally:
+            self.pending.discard(key)
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            now = datetime.now(timezone('Asia/Seoul'))
+            try:
+                if self.user_infos_loaded_at is None or now - self.user_infos_loaded_at > self.user_refresh:
+                    self.user_infos = await run_blocking(self.load_user_infos)
+                    self.user_infos_loaded_at = now
+                    alarm_timetable.rebuild(self.user_infos)
+
+                for key in [key for key, expires_at in self.stored.items() if expires_at < now]:
+                    del self.stored[key]
+
+                # alarms ringing between now and lead minutes from now that have no greeting yet
+                now_minute = now.hour * 60 + now.minute
+                lead_minutes = int(self.lead.total_seconds() // 60)
+                for minute, phone_id, kind in alarm_timetable.upcoming(now_minute, lead_minutes + 1):
+                    alarm_at = now.replace(second=0, microsecond=0) + timedelta(minutes=(minute - now_minute) % 1440)
+                    user_info = self.user_infos[phone_id]
+                    session = UserSession(phone_id, user_info, now=alarm_at, pregeneration=True)
+                    key = self.slot_key(session)
+                    if key is None or key in self.stored or key in self.pending:
+                        continue
+                    self.pending.add(key)
+                    asyncio.create_task(self._generate_slot(key, session, user_info, semaphore))
+            except Exception as e:
+                print(f"Greeting pre-generation error: {e}")
+
+            await asyncio.sleep(60)
+
+    # pre-generated greeting for a live session (removed from the store), None on a miss
+    async def take(self, session):
+        key = self.slot_key(session)
+        entry = await session_store.pop_shared(self.store_key(key)) if key is not None else None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry["pcm"] = await run_blocking(synthesize_tts_pcm, entry["text"])
+        return entry
+
+    def stats(self):
+        return {"stored": len(self.stored), "pending": len(self.pending), "hits": self.hits,
+                "misses": self.misses, "generated": self.generated, "failed": self.failed}
+
+
+greeting_pregenerator = GreetingPregenerator(lead_minutes=int(os.environ.get('ELF_GREETING_LEAD_MINUTES', '5')))
 
 # %%
 # update database user information table using username when accessing app at the first time
 def phoneid_db_search_update(phone_id, name):
     
     try:
-      connection = pymysql.connect(**db_config)
-      cursor = connection.cursor()
+      with db_pool.connection() as connection, connection.cursor() as cursor:
       
-      # 트랜잭션 시작
-      connection.begin()
+          # 트랜잭션 시작
+          connection.begin()
       
-      usernameselectquery = """SELECT username FROM user WHERE username = %s;"""
-      unsvalues = (name)
-      cursor.execute(usernameselectquery,unsvalues)
-      data = cursor.fetchall()
+          cursor.execute(queries.USERNAME_EXISTS, (name,))
+          data = cursor.fetchall()
       
-      if not data:
-          return False
-      else:
+          if not data:
+              return False
+          else:
         
-        # update user table
-        userupdatequery = """UPDATE user 
-                                SET phone_id = %s WHERE username = %s;"""
-        uuvalues = (phone_id, name)
-        cursor.execute(userupdatequery, uuvalues)
-        print("Update phone_id to user table.")
-        
-        
-        # update alarm table
-        alarmupdatequery = """UPDATE alarm
-                                SET phone_id = %s WHERE username = %s;"""
-        auvalues = (phone_id, name)
-        cursor.execute(alarmupdatequery, auvalues)
-        print("Update phone_id to alarm table.")
-        
-        
-        # update healthinfo table
-        healthinfoupdatequery = """UPDATE healthinfo
-                                    SET phone_id = %s WHERE username = %s;"""
-        huvalues = (phone_id, name)
-        cursor.execute(healthinfoupdatequery, huvalues)
-        print("Update phone_id to healthinfo table.")
-        
-        #update context table
-        contextupdatequery = """UPDATE context
-                                SET phone_id = %s WHERE username = %s;"""
-        cxvalues = (phone_id, name)
-        cursor.execute(contextupdatequery, cxvalues)
-        print("Update phone_id to context table.")
-        
-        # update summarization table
-        summupdatequery = """UPDATE summarization
-                        SET phone_id = %s WHERE username = %s;"""
-        suvalues = (phone_id, name)
-        cursor.execute(summupdatequery, suvalues)
-        print("Update phone_id to summarization table.")
+            # update user, alarm, healthinfo, context and summarization tables
+            for table, updatequery in queries.PHONE_ID_UPDATES.items():
+                cursor.execute(updatequery, (phone_id, name))
+                print(f"Update phone_id to {table} table.")
       
-      connection.commit()
-      return True
+          connection.commit()
+          invalidate_profile_everywhere(phone_id, name)
+          return True
 
       
     except pymysql.Error as error:
       print(f"Error while connecting to MySQL: {error}")
-      connection.rollback()
       return False
 
-    finally:
-      cursor.close()
-      connection.close()
       
 
 # to display previous conversation history on app whenever accessing the app
 def preconv_history_json(phone_id):
     
     try:
-      connection = pymysql.connect(**db_config)
-      cursor = connection.cursor()
+      with db_pool.connection() as connection, connection.cursor() as cursor:
       
       
-      recallquery = """SELECT created_at, role, content 
-                        FROM (
-                            SELECT created_at, role, content 
-                            FROM context 
-                            WHERE phone_id = %s 
-                            ORDER BY created_at DESC 
-                            LIMIT 20
-                        ) AS subquery 
-                        ORDER BY created_at ASC;"""
-      values = (phone_id)
-      cursor.execute(recallquery,values)
-      data = cursor.fetchall()
+          cursor.execute(queries.RECENT_HISTORY, (phone_id,))
+          data = cursor.fetchall()
       
-      if not data or (len(data) == 1 and data[0][1] == "initialization"):
-          return False
+          if not data or (len(data) == 1 and data[0][1] == "initialization"):
+              return False
       
     except pymysql.Error as error:
       print(f"Error while connecting to MySQL: {error}")
-      connection.rollback()
       return False
 
-    finally:
-      cursor.close()
-      connection.close()
 
     messages = []
     for entry in data:
@@ -1074,19 +2010,144 @@ def read_version_from_file(file_path):
         return None
     except IOError:
         return None
+
+# Current app version held in memory.
+# version.txt is only re-read when its mtime changes (checked every interval seconds, or right away
+# when dbinsert_web.py reports a new build), and a new version is pushed to every connected phone.
+class AppVersionWatcher:
+    def __init__(self, file_path, interval=5):
+        self.file_path = file_path
+        self.interval = interval
+        self.version = None
+        self.mtime_ns = None
+        self.lock = asyncio.Lock()
+        self.reads = 0
+        self.pushes = 0
+
+    # blocking: re-read version.txt if it changed, returns True if the version changed
+    def refresh(self):
+        try:
+            mtime_ns = os.stat(self.file_path).st_mtime_ns
+        except OSError:
+            mtime_ns = None
+        if mtime_ns == self.mtime_ns:
+            return False
+
+        self.mtime_ns = mtime_ns
+        self.reads += 1
+        version = read_version_from_file(self.file_path) if mtime_ns is not None else None
+        changed = version != self.version
+        self.version = version
+        return changed
+
+    # re-check the file and push the version to all clients when it changed
+    async def check(self, push=True):
+        async with self.lock:
+            changed = await run_blocking(self.refresh)
+            if changed and push and self.version:
+                print(f"New app version published: {self.version}")
+                self.pushes += 1
+                # every worker runs its own watcher, so each one pushes to its own sockets
+                await manager.broadcast_local(f"version#{self.version}")
+            return changed
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception as e:
+                print(f"Version check failed: {e}")
+
+    def get(self):
+        return self.version
+
+    def stats(self):
+        return {"version": self.version, "file_reads": self.reads, "pushes": self.pushes}
+
+
+app_version = AppVersionWatcher(
+    os.environ.get('ELF_VERSION_FILE', '/var/www/html/downloads/seniorcare/version.txt'),
+    interval=int(os.environ.get('ELF_VERSION_CHECK_INTERVAL', '5'))
+)
 ##############################
 
+# %%
+# Several workers (processes, possibly on several nodes) serve the apps behind one endpoint.
+# Each socket and its session live in one worker; the session store records which worker owns each phone_id,
+# and the pub/sub channel carries messages to the owner and events to every worker (see session_store.py).
+# ELF_SESSION_BACKEND=redis://host:6379/0 when running more than one worker, "memory" for a single one.
+session_store, pubsub = create_session_backend(
+    os.environ.get('ELF_SESSION_BACKEND', 'memory'),
+    ttl=int(os.environ.get('ELF_SESSION_OWNER_TTL', '120'))
+)
+
+EVENTS_CHANNEL = "elf:events" # events for every worker
+
+# messages for the sockets owned by one worker
+def worker_channel(worker_id):
+    return f"elf:worker:{worker_id}"
+
+cluster_metrics = {"routed_out": 0, "routed_in": 0, "undeliverable": 0, "events_published": 0, "events_received": 0, "takeovers": 0}
+
+# publish an event to the other workers (the caller has handled it in this worker already)
+async def publish_event(event_type, **fields):
+    await pubsub.publish(EVENTS_CHANNEL, dict(fields, type=event_type, worker=WORKER_ID))
+    cluster_metrics["events_published"] += 1
+
+worker_loop = None   # event loop of this worker, set at startup, for events published from executor threads
+
+def log_publish_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Cluster event publish failed: {future.exception()}")
+
+# drop a changed profile from the cache of every worker : here right away, in the others through the event.
+# Called from the executor threads that write profiles, so the publish is handed to the event loop.
+def invalidate_profile_everywhere(phone_id=None, username=None):
+    profile_cache.invalidate(phone_id, username)
+    if worker_loop is None:
+        return
+    future = asyncio.run_coroutine_threadsafe(publish_event("profile_invalidate", phone_id=phone_id, username=username), worker_loop)
+    future.add_done_callback(log_publish_failure)
+
+
 class ConnectionManager:
     def __init__(self):
         self.active_connections: Dict[str, WebSocket] = {}
         self.user_info: Dict[str, UserInfo] = {}
         self.session: Dict[str, UserSession] = {}
+        self.client_options: Dict[str, dict] = {}
+        self.actors: Dict[str, "SessionActor"] = {}
+        # connect and disconnect of one phone_id run one at a time, so the cleanup of an old socket
+        # never removes the entries of the new connection that replaced it
+        self.phone_locks: Dict[str, asyncio.Lock] = {}
 
             
+    # returns the actor that handles the messages of the new socket
     async def connect(self, websocket: WebSocket, phone_id: str):
         await websocket.accept()
-        self.active_connections[phone_id] = websocket
-        self.updateUserInfo(phone_id)
+        async with self.phone_locks.setdefault(phone_id, asyncio.Lock()):
+            # the app reconnected before its old socket on this worker noticed the disconnect
+            previous = self.actors.get(phone_id)
+            if previous is not None:
+                await previous.close_for_takeover()
+
+            self.active_connections[phone_id] = websocket
+            # apps that connect with "?tts=stream" receive tts audio as streamed pcm chunks
+            # apps that connect with "?audio=binary" (or send a binary frame) receive audio as binary frames
+            self.client_options[phone_id] = {
+                "tts_stream": websocket.query_params.get("tts") == "stream",
+                "binary_audio": websocket.query_params.get("audio") == "binary",
+            }
+            await run_blocking(self.updateUserInfo, phone_id)
+            actor = self.actors[phone_id] = SessionActor(websocket, phone_id)
+
+            # this worker owns the socket now; a connection of the same app left on another worker is closed
+            previous_owner = await session_store.claim(phone_id, WORKER_ID)
+            if previous_owner is not None and previous_owner != WORKER_ID:
+                cluster_metrics["takeovers"] += 1
+                await pubsub.publish(worker_channel(previous_owner), {"type": "close", "phone_id": phone_id, "worker": WORKER_ID})
+        return actor
     
     
     def getUserInfo(self, phone_id: str):
@@ -1110,159 +2171,500 @@ class ConnectionManager:
         return self.session[phone_id]
     
     
+    def isTTSStreaming(self, phone_id: str):
+        return self.client_options.get(phone_id, {}).get("tts_stream", False)
+    
+    
+    def isBinaryAudio(self, phone_id: str):
+        return self.client_options.get(phone_id, {}).get("binary_audio", False)
+    
+    
+    def setBinaryAudio(self, phone_id: str):
+        if phone_id in self.client_options:
+            self.client_options[phone_id]["binary_audio"] = True
+    
+    
     def updateUserInfo(self, phone_id: str):
-        user_info_obj = UserInfo(db_config)
-        self.user_info[phone_id] = user_info_obj.get_user_info(phone_id)
+        self.user_info[phone_id] = profile_cache.get(phone_id)
         if self.user_info[phone_id] is not None:
             self.session[phone_id] = UserSession(phone_id, self.user_info[phone_id])
     
         
-    def disconnect(self, phone_id: str):
-        if phone_id in self.active_connections:
-            del self.active_connections[phone_id]
-            
-        if phone_id in self.user_info:
-            del self.user_info[phone_id]
-            
-        if phone_id in self.session:
-            del self.session[phone_id]
+    # remove the entries of a closed socket and give up its ownership, returns (session, user_info) of the socket.
+    # A socket taken over by a new connection keeps nothing here : its session was kept by close_for_takeover().
+    async def disconnect(self, actor: "SessionActor"):
+        phone_id = actor.phone_id
+        async with self.phone_locks.setdefault(phone_id, asyncio.Lock()):
+            if self.actors.get(phone_id) is not actor:
+                return actor.session, actor.user_info
+
+            session, user_info = self.session.pop(phone_id, None), self.user_info.pop(phone_id, None)
+            del self.actors[phone_id]
+            self.active_connections.pop(phone_id, None)
+            self.client_options.pop(phone_id, None)
+            await session_store.release(phone_id, WORKER_ID)
+            return session, user_info
             
     
+    # the app may be connected to another worker : the message is then routed to the worker that owns its socket
     async def send_message(self, message: str, phone_id: str):
         websocket = self.active_connections.get(phone_id)
         if websocket:
             await websocket.send_text(message)
+            return
+
+        owner = await session_store.owner(phone_id)
+        if owner is None or owner == WORKER_ID:
+            cluster_metrics["undeliverable"] += 1
+            return
+        await pubsub.publish(worker_channel(owner), {"type": "send", "phone_id": phone_id, "message": message, "worker": WORKER_ID})
+        cluster_metrics["routed_out"] += 1
+    
+    # send audio as a binary frame, or as legacy "command#<base64>" text for apps without binary support
+    async def send_audio(self, command: str, phone_id: str, audio: bytes):
+        websocket = self.active_connections.get(phone_id)
+        if websocket:
+            if self.isBinaryAudio(phone_id):
+                await websocket.send_bytes(pack_audio_frame(command, phone_id, audio))
+            elif command.endswith("_chunk"):
+                # stream chunks are plain base64 (see stream_tts_to_client)
+                await websocket.send_text(f"{command}#{base64.b64encode(audio).decode('ascii')}")
+            else:
+                # the old app parses the whole audio messages with the b'...' around the base64 text
+                await websocket.send_text(f"{command}#{base64.b64encode(audio)}")
     
+    # every connected app, on all workers
     async def broadcast(self, message: str):
-        for websocket in self.active_connections.values():
-            await websocket.send_text(message)
+        await self.broadcast_local(message)
+        await publish_event("broadcast", message=message)
+    
+    # the apps connected to this worker
+    async def broadcast_local(self, message: str):
+        # one closed socket must not stop the message from reaching the others
+        results = await asyncio.gather(*[websocket.send_text(message) for websocket in list(self.active_connections.values())],
+                                       return_exceptions=True)
+        for error in results:
+            if isinstance(error, Exception):
+                print(f"Broadcast failed: {error}")
             
 
 manager = ConnectionManager()
 app = FastAPI()
 
 
-@app.websocket("/ws/{phone_id}")
-async def websocket_endpoint(websocket: WebSocket, phone_id: str):
-    await manager.connect(websocket, phone_id)
-    print(f"client connected: {websocket.client}")
- 
-    #user_info = None
-    #session = None
-    
-    context = []
-    context_string = []
-    context_counter = 0
+# events and routed messages from the other workers
+async def handle_cluster_event(event):
+    if event.get("worker") == WORKER_ID:
+        return
+    cluster_metrics["events_received"] += 1
+    event_type = event["type"]
+
+    if event_type == "send": # this worker owns the socket
+        websocket = manager.active_connections.get(event["phone_id"])
+        if websocket:
+            await websocket.send_text(event["message"])
+            cluster_metrics["routed_in"] += 1
+        else:
+            cluster_metrics["undeliverable"] += 1
+
+    elif event_type == "close": # the app has reconnected to another worker
+        websocket = manager.active_connections.get(event["phone_id"])
+        if websocket:
+            print(f"Connection of {event['phone_id']} taken over by {event['worker']}")
+            await websocket.close(code=1000)
 
-    # try:
+    elif event_type == "broadcast":
+        await manager.broadcast_local(event["message"])
+
+    elif event_type == "profile_invalidate":
+        profile_cache.invalidate(event.get("phone_id"), event.get("username"))
+
+    elif event_type == "version_check":
+        await app_version.check()
+
+
+async def cluster_event_listener():
     while True:
+        try:
+            async for _, event in pubsub.listen([EVENTS_CHANNEL, worker_channel(WORKER_ID)]):
+                try:
+                    await handle_cluster_event(event)
+                except Exception as e:
+                    print(f"Cluster event {event.get('type')} failed: {e}")
+        except Exception as e:
+            print(f"Cluster event listener error: {e}")
+        await asyncio.sleep(1) # e.g. the redis server restarted : subscribe again
+
+
+# keep the ownership of this worker's sockets from expiring (entries of a dead worker expire after the ttl)
+async def session_owner_refresh(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await session_store.refresh(list(manager.active_connections), WORKER_ID)
+        except Exception as e:
+            print(f"Session owner refresh failed: {e}")
+
+
+# start shared clients and background tasks
+@app.on_event("startup")
+async def start_background_tasks():
+    global worker_slot, worker_slot_lock, worker_loop
+    worker_loop = asyncio.get_running_loop()
+    worker_slot, worker_slot_lock = claim_worker_slot(os.environ.get('ELF_WORKER_LOCK_DIR', './worker_locks'))
+    context_writer.journal_path = worker_file(context_writer.journal_path)
+    summarization_queue.journal_path = worker_file(summarization_queue.journal_path)
+    await weather_cache.start()
+    print(f"Context rows restored from the journal : {await run_blocking(context_writer.load_journal)}")
+    await run_blocking(context_writer.flush_all)
+    await summarization_queue.start()
+    await app_version.check(push=False)
+    await run_blocking(stt_backend.load)    # local stt models are loaded once, before the first turn
+    app.state.background_tasks = [asyncio.create_task(weather_prefetcher()),
+                                  asyncio.create_task(app_version.run()),
+                                  asyncio.create_task(context_writer_retry()),
+                                  asyncio.create_task(cluster_event_listener()),
+                                  asyncio.create_task(session_owner_refresh(max(1, int(os.environ.get('ELF_SESSION_OWNER_TTL', '120')) // 3)))]
+    # once per node : the audio files and the alarm greetings would otherwise be processed by every worker
+    if worker_slot == 0:
+        app.state.background_tasks += [asyncio.create_task(greeting_pregenerator.run()),
+                                       asyncio.create_task(audio_archive_loop())]
+    print(f"Worker {WORKER_ID} started in slot {worker_slot} ({session_store.name} session backend)")
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for task in app.state.background_tasks:
+        task.cancel()
+    await weather_cache.close()
+    await summarization_queue.stop()
+    await session_store.close()
+    if worker_slot_lock is not None:
+        worker_slot_lock.close()
+
+
+# runtime metrics of the server (connection pool usage etc.)
+@app.get("/metrics")
+async def get_metrics():
+    return {"db_pool": db_pool.stats(),
+            "weather_cache": weather_cache.stats(),
+            "greeting_pregeneration": greeting_pregenerator.stats(),
+            "summarization_queue": summarization_queue.stats(),
+            "context_writer": context_writer.stats(),
+            "profile_cache": profile_cache.stats(),
+            "app_version": app_version.stats(),
+            "stt": stt_backend.stats(),
+            "vad": vad_trimmer.stats(stt_backend.stats()["real_time_factor"]),
+            "audio_archive": audio_archiver.stats(),
+            "tts_cache": tts_cache.stats(),
+            "ttfa": ttfa_metrics,
+            "sessions": {"active": len(manager.actors), "queued": sum(actor.inbox.qsize() for actor in manager.actors.values()),
+                         **session_metrics},
+            "cluster": {"worker_id": WORKER_ID, "worker_slot": worker_slot, "backend": session_store.name,
+                        "local_sockets": len(manager.active_connections), **cluster_metrics},
+            "prompts": prompt_stats()}
+
+
+# prompt sizes over the connected sessions (aggregates only : /metrics must not list the users)
+def prompt_stats():
+    stats = [session.prompt_builder.stats() for session in list(manager.session.values())]
+    stats = [stat for stat in stats if stat["builds"]]
+    if not stats:
+        return {"sessions": 0}
+    prompt_tokens = [stat["prompt_tokens"] for stat in stats]
+    build_ms = [stat["build_ms"] for stat in stats]
+    return {"sessions": len(stats),
+            "builds": sum(stat["builds"] for stat in stats),
+            "avg_prompt_tokens": round(sum(prompt_tokens) / len(stats), 1),
+            "max_prompt_tokens": max(prompt_tokens),
+            "avg_static_prefix_tokens": round(sum(stat["static_prefix_tokens"] for stat in stats) / len(stats), 1),
+            "avg_build_ms": round(sum(build_ms) / len(stats), 3),
+            "max_build_ms": max(build_ms)}
+
+
+# invalidation hook for profile changes made by other processes (e.g. /adduser of dbinsert_web.py)
+@app.post("/internal/profile_invalidate")
+async def invalidate_profile(request: Request):
+    if request.client is None or request.client.host not in ("127.0.0.1", "::1"):
+        raise HTTPException(status_code=403, detail="local requests only")
+    data = await request.json()
+    profile_cache.invalidate(data.get("phone_id"), data.get("username"))
+    # the other workers have their own profile caches
+    await publish_event("profile_invalidate", phone_id=data.get("phone_id"), username=data.get("username"))
+    return {"invalidated": True}
+
+
+# publish hook called by /upload_func of dbinsert_web.py once a new build and its version.txt are in place
+@app.post("/internal/version_published")
+async def version_published(request: Request):
+    if request.client is None or request.client.host not in ("127.0.0.1", "::1"):
+        raise HTTPException(status_code=403, detail="local requests only")
+    changed = await app_version.check()
+    # every worker re-reads the version and pushes it to its own sockets
+    await publish_event("version_check")
+    return {"version": app_version.get(), "pushed": changed}
+
+
+# %%
+# One actor per connected app. The websocket only receives and parses messages and puts them in the actor's inbox;
+# the actor handles them one at a time, so the turns of one user never overlap (context_counter, audio file names)
+# while the actors of different users run concurrently.
+# The reply part of a turn (llm answer and its tts) runs as a separate task : a new utterance that arrives
+# while the reply is still generating cancels it (barge-in) instead of waiting behind stale audio.
+SESSION_INBOX_SIZE = int(os.environ.get('ELF_SESSION_INBOX_SIZE', '8'))
+
+session_metrics = {"turns": 0, "barge_ins": 0, "ignored_messages": 0, "errors": 0}
+
+class SessionActor:
+    def __init__(self, websocket: WebSocket, phone_id: str):
+        self.websocket = websocket
+        self.phone_id = phone_id
+        self.inbox = asyncio.Queue(SESSION_INBOX_SIZE)
+        self.task = None
+        self.reply_task = None
+        self.utterances = 0     # human_cvs messages received, to tell whether a turn is still the latest one
+        self.session = None     # session and user_info of this socket once a new connection took them over
+        self.user_info = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    # called by the websocket receive loop for every message of the app
+    async def submit(self, command, audio_payload):
+        if self.task.done(): # stopped after an error, the socket is closing
+            return
+        # messages are always handled for the user of this socket, and others must not interrupt its reply
+        if command[1] != self.phone_id:
+            print(f"Ignored {command[0]} for {command[1]} on the socket of {self.phone_id}")
+            session_metrics["ignored_messages"] += 1
+            return
+        if "human_cvs" in command[0]:
+            self.utterances += 1
+            if self.reply_task is not None and not self.reply_task.done():
+                self.reply_task.cancel()
+                session_metrics["barge_ins"] += 1
+                print(f"Barge-in : reply to {self.phone_id} cancelled")
+        await self.inbox.put((command, audio_payload, time.perf_counter(), self.utterances))
+
+    async def run(self):
+        while True:
+            command, audio_payload, received, utterance = await self.inbox.get()
+            try:
+                await self.handle(command, audio_payload, received, utterance)
+            except Exception as e:
+                # same as before the actors : an error ends the session (summarization is queued on disconnect)
+                print(f"Error: {e}")
+                session_metrics["errors"] += 1
+                await self.websocket.close(code=1011)
+                return
+
+    # stop the actor and any reply in progress (on disconnect); returns once their blocking work has finished
+    async def close(self):
+        tasks = [task for task in (self.reply_task, self.task) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        while not self.inbox.empty(): # release a receive loop blocked on a full inbox
+            self.inbox.get_nowait()
+
+    # the app connected again on this worker while this socket was still open (called by manager.connect) :
+    # keep this socket's session for its summary, stop handling its messages and close it
+    async def close_for_takeover(self):
+        self.session, self.user_info = manager.session.get(self.phone_id), manager.user_info.get(self.phone_id)
+        cluster_metrics["takeovers"] += 1
+        await self.close()
+        try:
+            await self.websocket.close(code=1000)
+        except Exception: # already closed by the app
+            pass
 
+    # run the reply of a turn as its own task; returns False when it was cancelled by a barge-in
+    async def reply(self, coro):
+        self.reply_task = asyncio.create_task(coro)
         try:
-            data = await websocket.receive_text()
-            print(f"Received text data: {data}")
-            command = data.split("#")
+            await asyncio.wait([self.reply_task])
+        finally:
+            if not self.reply_task.done(): # the actor itself is stopped
+                self.reply_task.cancel()
+        if self.reply_task.cancelled():
+            return False
+        self.reply_task.result() # errors of the reply end the session like any other error
+        return True
+
+    async def handle(self, command, audio_payload, received, utterance):
+        # automatically update app
+        if "version" in command[0]:
+            # served from memory; new versions are also pushed to the app as soon as they are published
+            version = app_version.get()
+            
+            if version:
+                await manager.send_message(f"version#{version}", self.phone_id)
+            else:
+                await manager.send_message("version#ERROR", self.phone_id)
+
+        # when getting search command from app, search user information whenevr accessing app
+        elif "search" in command[0]:
+            if manager.getUserInfo(self.phone_id) is None: # if userinfo is none send "sesarch#error_no_user" to app
+                await manager.send_message("search#error_no_user", self.phone_id)
+                return
+
+            # send userinfo as json format with "search" command to app
+            search_message = f"search#{json.dumps(manager.getUserInfo2Json(self.phone_id),default=str, ensure_ascii = False)}"
+            await manager.send_message(search_message, self.phone_id)
+            print(search_message)
+
+        # when getting register command from app, search database and update database according to the existance of user information
+        elif "register" in command[0]:
+            name = command[2]
+            if await run_blocking(phoneid_db_search_update, self.phone_id, name): # db에 이름이 있어서 phone_id 업데이트 성공한 경우
+                    await manager.send_message("register#OK", self.phone_id)
+                    await run_blocking(manager.updateUserInfo, self.phone_id)
+                    
+            else:
+                    await manager.send_message("register#ERROR", self.phone_id)
+
+        # when getting prev_cvs command from app, send previous conversation to app
+        elif "prev_cvs" in command[0]:
+            preconv_history = await run_blocking(preconv_history_json, self.phone_id)
+            await manager.send_message(f"prev_cvs#{json.dumps(preconv_history, default = str, ensure_ascii=False)}", self.phone_id)
+            
+        # when getting welcome_tts command from app, send greeting_text derived from get_greeting_response function and audio file
+        elif "welcome_tts" in command[0]:
+            await self.reply(self.welcome_greeting())
+            flush_context_later(manager.getSession(self.phone_id).session_id)
+      
+        # when getting human_cvs command and human answer audiofile from app, save audiofile in server, transform speech to text, send the text to app
+        elif "human_cvs" in command[0]:
+            await self.human_turn(command, audio_payload, received, utterance)
+
+    async def welcome_greeting(self):
+        phone_id = self.phone_id
+        pregenerated = await greeting_pregenerator.take(manager.getSession(phone_id))
+
+        if pregenerated is not None: # greeting and audio were made before the alarm
+            greeting_text = pregenerated["text"]
+            await run_blocking_to_completion(save_greeting, manager.getSession(phone_id), manager.getUserInfo(phone_id), greeting_text, pregenerated["conversation_start"], pregenerated["conv_model"])
+            if manager.isTTSStreaming(phone_id):
+                await send_pcm_to_client(pregenerated["pcm"], "welcome_tts", phone_id)
+            else:
+                await manager.send_audio("welcome_tts", phone_id, pcm_to_wav(pregenerated["pcm"]))
+            await manager.send_message(f"welcome_tts_text#{greeting_text}", phone_id)
+            print("greeting text (pre-generated) : ", greeting_text)
+            return
+
+        greeting_text = await run_blocking_to_completion(get_greeting_response, manager.getSession(phone_id), manager.getUserInfo(phone_id))
+
+        if manager.isTTSStreaming(phone_id):
+            await stream_tts_to_client(greeting_text, "welcome_tts", phone_id)
+        else:
+            greeting_wav = await run_blocking(synthesize_tts_wav, greeting_text)
+            # print(len(greeting_wav))
+            await manager.send_audio("welcome_tts", phone_id, greeting_wav)
+        await manager.send_message(f"welcome_tts_text#{greeting_text}", phone_id)
+        print("greeting text : ", greeting_text)
+
+    # utterance : number of this human_cvs message, a larger self.utterances means the user has already said more
+    async def human_turn(self, command, audio_payload, turn_started, utterance):
+        phone_id = self.phone_id
+        session = manager.getSession(phone_id)
+        # turn_started : when the utterance was received, to measure time-to-first-audio of the answer
+        if audio_payload is not None: # binary frame : raw pcm, no decoding needed
+            audio_data = audio_payload
+        else:
+            audio_data = command[2]
+            audio_data = base64.b64decode(audio_data)
+        # print(len(audio_data))
+
+        # trim leading and trailing silence; a turn without any speech is not transcribed, stored or answered
+        audio_data, removed_seconds = await run_blocking(vad_trimmer.trim, audio_data)
+        if audio_data is None:
+            print(f"Silent turn rejected ({removed_seconds:.1f}s of audio)")
+            await manager.send_message("human_cvs_silence#", phone_id)
+            return
+        session_metrics["turns"] += 1
+        # human audiofile path, named by the context number the user turn will get
+        humancvs_file_path = get_user_audio_path(session, session.context_counter + 1)
+        # save human audiofile and run stt on the in-memory pcm at the same time
+        _, transcription_text = await asyncio.gather(run_blocking(save_wav, audio_data, humancvs_file_path),
+                                                     run_blocking(get_transcript, audio_data))
+        transcript_time = datetime.now(timezone('Asia/Seoul')).strftime('%Y-%m-%d %H:%M:%S') # to save time of transcript into database
+        await manager.send_message(f"human_cvs_text#{transcription_text}", phone_id)
+        print("transcription_text : ", transcription_text)
+
+        if self.utterances > utterance:
+            # the user spoke again during stt (barge-in before the reply started) : keep what they said, answer only the latest
+            session_metrics["barge_ins"] += 1
+            print(f"Barge-in : reply to {phone_id} skipped")
+            await run_blocking_to_completion(save_user_input, session, manager.getUserInfo(phone_id), transcription_text, transcript_time, humancvs_file_path)
+        else:
+            await self.reply(self.answer(session, transcription_text, transcript_time, humancvs_file_path, turn_started))
+
+        # the turn is over (or interrupted) : write its user and assistant rows in one batch
+        flush_context_later(session.session_id)
+
+        # once the turns pass the high-water mark, the oldest ones are folded into the rolling summary in the background
+        if session.context.needs_compaction():
+            blocking_executor.submit(compact_context, session.context)
+
+    async def answer(self, session, transcription_text, transcript_time, humancvs_file_path, turn_started):
+        phone_id = self.phone_id
+        if manager.isTTSStreaming(phone_id):
+            # token-streamed chatgpt answer : each sentence is sent to tts and to the app while the next ones are still generating
+            llm_sentences = iterate_blocking(iter_chat_with_gpt_sentences, session, manager.getUserInfo(phone_id), transcription_text, transcript_time, humancvs_file_path)
+            await stream_tts_to_client(llm_sentences, "ai_cvs", phone_id, turn_started) # stream ai answer audio to app
+            llm_response = session.context[-1]["content"]
+        else:
+            llm_response = await run_blocking_to_completion(chat_with_gpt, session, manager.getUserInfo(phone_id), transcription_text, transcript_time, humancvs_file_path) # derive chatgpt answer
+
+            answer_wav = await run_blocking(synthesize_tts_wav, llm_response)
+            # print(len(answer_wav))
+            await manager.send_audio("ai_cvs", phone_id, answer_wav) # send ai answer audiofile to app
+            record_ttfa("ai_cvs_file", time.perf_counter() - turn_started)
+        await manager.send_message(f"ai_cvs_text#{llm_response}", phone_id) # send ai answer text to app
+        print("llm_response : ", llm_response)
+
+
+@app.websocket("/ws/{phone_id}")
+async def websocket_endpoint(websocket: WebSocket, phone_id: str):
+    actor = await manager.connect(websocket, phone_id)
+    print(f"client connected: {websocket.client}")
+    actor.start()
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+
+            if message.get("bytes") is not None:
+                command_name, frame_phone_id, audio_payload = unpack_audio_frame(message["bytes"])
+                manager.setBinaryAudio(phone_id)
+                print(f"Received binary data: {command_name}#{frame_phone_id} ({len(audio_payload)} bytes)")
+                command = [command_name, frame_phone_id]
+            else:
+                data = message["text"]
+                audio_payload = None
+                print(f"Received text data: {data}")
+                command = data.split("#")
             
             if len(command) < 2:
                 continue
-            
-            # automatically update app
-            if "version" in command[0]:
-                version_file_path = "/var/www/html/downloads/seniorcare/version.txt"
-                version = read_version_from_file(version_file_path)
-                
-                if version:
-                    await manager.send_message(f"version#{version}", phone_id)
-                else:
-                    await manager.send_message("version#ERROR", phone_id)
-
-            # when getting search command from app, search user information whenevr accessing app
-            elif "search" in command[0]:
-                uid = command[1]
-                if manager.getUserInfo(uid) is None: # if userinfo is none send "sesarch#error_no_user" to app
-                    await manager.send_message("search#error_no_user", uid)
-                    continue
-
-                # send userinfo as json format with "search" command to app
-                await manager.send_message(f"search#{json.dumps(manager.getUserInfo2Json(uid),default=str, ensure_ascii = False)}", uid)
-                print(f"search#{json.dumps(manager.getUserInfo2Json(uid),default=str, ensure_ascii = False)}")
-
-            # when getting register command from app, search database and update database according to the existance of user information
-            elif "register" in command[0]:
-                uid = command[1]
-                name = command[2]
-                if phoneid_db_search_update(uid, name): # db에 이름이 있어서 phone_id 업데이트 성공한 경우
-                        await manager.send_message("register#OK", uid)
-                        manager.updateUserInfo(uid)
-                        
-                else:
-                        await manager.send_message("register#ERROR", uid)
 
-            # when getting prev_cvs command from app, send previous conversation to app
-            elif "prev_cvs" in command[0]:
-                uid = command[1]
-                await manager.send_message(f"prev_cvs#{json.dumps(preconv_history_json(uid), default = str, ensure_ascii=False)}", uid)
-                
-            # when getting welcome_tts command from app, send greeting_text derived from get_greeting_response function and audio file
-            elif "welcome_tts" in command[0]:
-                uid = command[1]
-                greeting_text = get_greeting_response(manager.getSession(uid), manager.getUserInfo(uid))
-
-                greeting_file_path = f"./{manager.getSession(uid).session_id}_greeting.wav"
-                play_chatgpt_response_with_tts(greeting_text, greeting_file_path)
-
-                with open(greeting_file_path, "rb") as audio_file:
-                    greeting_wav = audio_file.read()
-                    greeting_wav = base64.b64encode(greeting_wav)
-                    # print(len(greeting_wav))
-                    await manager.send_message(f"welcome_tts#{greeting_wav}", uid)
-                os.remove(greeting_file_path)
-                await manager.send_message(f"welcome_tts_text#{greeting_text}", uid)
-                print("greeting text : ", greeting_text)
-          
-            # when getting human_cvs command and human answer audiofile from app, save audiofile in server, transform speech to text, send the text to app
-            elif "human_cvs" in command[0]:
-                uid = command[1]
-                audio_data = command[2]
-                audio_data = base64.b64decode(audio_data)
-                # print(len(audio_data))
-                humancvs_file_path = f"./useraudiofile/{manager.getSession(uid).session_id}_.wav" # human audiofile path
-                save_wav(audio_data, humancvs_file_path) # save human audiofile
-
-                transcription_text = get_transcript(humancvs_file_path) # stt process
-                transcript_time = datetime.now(timezone('Asia/Seoul')).strftime('%Y-%m-%d %H:%M:%S') # to save time of transcript into database
-                await manager.send_message(f"human_cvs_text#{transcription_text}", uid)
-                print("transcription_text : ", transcription_text)
-
-                llm_response = chat_with_gpt(manager.getSession(uid), manager.getUserInfo(uid), transcription_text, transcript_time) # derive chatgpt answer
-                renamewavfile = rename_wav_file(manager.getSession(uid))
-                save_audiodir_to_context(manager.getSession(uid), renamewavfile)
-                
-                response_file_path = f"./{manager.getSession(uid).session_id}_response.wav"
-                play_chatgpt_response_with_tts(llm_response, response_file_path)
-
-                with open(response_file_path, "rb") as audio_file:
-                    answer_wav = audio_file.read()
-                    answer_wav = base64.b64encode(answer_wav)
-                    # print(len(answer_wav))
-                    await manager.send_message(f"ai_cvs#{answer_wav}", uid) # send ai answer audiofile to app
-                os.remove(response_file_path)
-                await manager.send_message(f"ai_cvs_text#{llm_response}", uid) # send ai answer text to app
-                print("llm_response : ", llm_response)
-
-        except WebSocketDisconnect:
-            print("Websocket disconnected")
-            # when websocket disconnect, summarization start
-            save_summarization_to_db(manager.getSession(uid), manager.getUserInfo(phone_id) if manager.getUserInfo(phone_id) else None)
-            print("Summarization saved to the database.")
-            manager.disconnect(uid)
-            break
-        
-        except Exception as e:
-            print(f"Error: {e}")
-            # when error, summarization start
-            save_summarization_to_db(manager.getSession(uid), manager.getUserInfo(phone_id) if manager.getUserInfo(phone_id) else None)
-            manager.disconnect(uid)
-            break
+            await actor.submit(command, audio_payload)
+
+    except WebSocketDisconnect:
+        print("Websocket disconnected")
+
+    except Exception as e:
+        print(f"Error: {e}")
+
+    # the turn in progress is stopped first, so its rows are in the context journal before it is flushed
+    await actor.close()
+    await run_blocking(context_writer.flush_all)
+    session, user_info = await manager.disconnect(actor)
+    # when websocket disconnect, summarization of this socket's own session is queued to the background workers
+    if await summarization_queue.submit(session, user_info):
+        print("Summarization queued.")
 
 def run():
     from hypercorn.config import Config
@@ -1271,8 +2673,20 @@ def run():
     
     config = Config()
     config.bind = ["0.0.0.0:8845"]
-    config.websocket_max_message_size = 16 * 1024 * 1024
-    asyncio.run(serve(app, config))
+    # binary audio frames carry raw 16kHz 16-bit pcm, so 16MB is about 8 minutes of speech per utterance
+    config.websocket_max_message_size = int(os.environ.get('ELF_WS_MAX_MESSAGE_SIZE', 16 * 1024 * 1024))
+
+    workers = int(os.environ.get('ELF_WORKERS', '1'))
+    if workers > 1:
+        # worker processes share the listening socket and load the app through elf_asgi.py
+        from hypercorn.run import run as run_workers
+        if session_store.name == "memory":
+            print("Warning: with the memory session backend, broadcasts, routed messages and pre-generated greetings only reach the same worker")
+        config.workers = workers
+        config.application_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "elf_asgi.py") + ":app"
+        run_workers(config)
+    else:
+        asyncio.run(serve(app, config))
     
     #uvicorn.run(app, host='0.0.0.0', port=8845, ws_max_size=16 * 1024 * 1024)
         
@@ -0,0 +1,188 @@
+
+# Content-addressed cache of synthesized speech
+#
+# Audio is stored on disk under the sha256 of (text, model, voice, speed, format), so the same sentence spoken
+# with the same settings is synthesized once: scripted greetings, the initialization greeting, stored
+# next_first_question values and common short answers. The cache is an LRU bounded by max_bytes
+# (file mtimes carry the LRU order across restarts). Concurrent requests for the same audio are collapsed
+# into one synthesis (single flight), also when the leader streams the audio while it arrives (begin / finish).
+
+
+from collections import OrderedDict
+from concurrent.futures import Future
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+
+class TTSCache:
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # key -> size, least recently used first
+        self.total_bytes = 0
+        self.inflight = {}              # key -> Future of the synthesis in progress
+
+        self.hits = 0
+        self.misses = 0
+        self.deduplicated = 0
+        self.evictions = 0
+        self.errors = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def make_key(text, model, voice, speed, response_format):
+        return hashlib.sha256(json.dumps([text, model, voice, speed, response_format], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    # rebuild the index from the files on disk, oldest access first
+    def _load(self):
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.startswith("."):
+                    continue
+                try:
+                    stat_result = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                files.append((stat_result.st_mtime, name, stat_result.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total_bytes += size
+        self._evict()
+
+    # drop least recently used entries until the cache fits (called with self.lock held or during init)
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    # cached audio or None
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as f:
+                audio = f.read()
+            os.utime(self._path(key))
+        except OSError:
+            with self.lock:
+                size = self.entries.pop(key, None)
+                if size is not None:
+                    self.total_bytes -= size
+            return None
+        with self.lock:
+            self.hits += 1
+        return audio
+
+    def put(self, key, audio):
+        if not audio or len(audio) > self.max_bytes:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+            with os.fdopen(fd, "wb") as f:
+                f.write(audio)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"TTS cache write failed: {e}")
+            with self.lock:
+                self.errors += 1
+            return
+        with self.lock:
+            self.total_bytes += len(audio) - self.entries.pop(key, 0)
+            self.entries[key] = len(audio)
+            self._evict()
+
+    # single flight of a miss : returns None when the caller is the first to synthesize key (the leader),
+    # who must then call finish() or abandon(). Otherwise returns the Future of the leader's audio.
+    def begin(self, key):
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is not None:
+                self.deduplicated += 1
+                return future
+            self.inflight[key] = Future()
+            self.misses += 1
+            return None
+
+    # the leader's synthesis is complete : cache it and hand it to the waiting callers
+    def finish(self, key, audio):
+        self.put(key, audio)
+        self._resolve(key, audio=audio)
+
+    # the leader failed or was interrupted : the waiting callers get the error and synthesize on their own
+    def abandon(self, key, error=None):
+        self._resolve(key, error=error or RuntimeError("tts synthesis abandoned"))
+
+    def _resolve(self, key, audio=None, error=None):
+        with self.lock:
+            future = self.inflight.pop(key, None)
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(audio)
+
+    # a miss that is synthesized outside the single flight (e.g. after the leader gave up)
+    def record_miss(self):
+        with self.lock:
+            self.misses += 1
+
+    # cached audio, or the result of synthesize() which is cached.
+    # If the same key is already being synthesized by another thread, wait for that result instead,
+    # and synthesize here if that synthesis fails or is interrupted (e.g. a stream stopped by barge-in).
+    def get_or_create(self, key, synthesize):
+        audio = self.get(key)
+        if audio is not None:
+            return audio
+
+        future = self.begin(key)
+        if future is not None:
+            try:
+                return future.result()
+            except Exception:
+                self.record_miss()
+            audio = synthesize()
+            self.put(key, audio)
+            return audio
+
+        try:
+            audio = synthesize()
+        except BaseException as e:
+            self.abandon(key, e)
+            raise
+        self.finish(key, audio)
+        return audio
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+                "deduplicated": self.deduplicated,
+                "evictions": self.evictions,
+                "errors": self.errors,
+            }
@@ -0,0 +1,80 @@
+
+# Energy based voice activity detection for the user's speech (16kHz, mono, 16-bit pcm)
+#
+# The app records from the moment the user taps until they stop, so turns carry long leading and trailing
+# silence. trim() cuts it off before STT and storage, using frame energies computed with NumPy in one pass.
+# Pauses inside the utterance are kept: only the span from the first to the last speech frame survives.
+
+
+import threading
+
+import numpy as np
+
+
+class VoiceActivityTrimmer:
+    def __init__(self, sample_rate=16000, frame_ms=30, margin_db=12.0, min_speech_db=-50.0, max_threshold_db=-35.0,
+                 min_speech_ms=200, padding_ms=300):
+        self.sample_rate = sample_rate
+        self.frame_size = sample_rate * frame_ms // 1000
+        self.margin_db = margin_db                  # speech has to be this much louder than the noise floor
+        self.min_speech_db = min_speech_db          # ... and at least this loud (dBFS)
+        self.max_threshold_db = max_threshold_db    # frames louder than this are always speech (turns without any pause)
+        self.min_speech_frames = max(1, min_speech_ms // frame_ms)
+        self.padding_frames = padding_ms // frame_ms    # kept around the speech so soft onsets/endings survive
+
+        self.lock = threading.Lock()
+        self.turns = 0
+        self.rejected = 0
+        self.seconds_in = 0.0
+        self.seconds_removed = 0.0
+
+    # energy (dBFS) of every frame
+    def frame_energies(self, samples):
+        n_frames = -(-len(samples) // self.frame_size)
+        frames = np.zeros(n_frames * self.frame_size, dtype=np.float32)
+        frames[:len(samples)] = samples
+        frames = frames.reshape(n_frames, self.frame_size) / 32768.0
+        return 10.0 * np.log10(np.mean(frames * frames, axis=1) + 1e-10)
+
+    # returns (trimmed pcm bytes or None if the turn is all silence, seconds removed)
+    def trim(self, pcm):
+        samples = np.frombuffer(pcm, dtype=np.int16, count=len(pcm) // 2) if len(pcm) >= 2 else np.zeros(0, dtype=np.int16)
+        seconds_in = len(samples) / self.sample_rate
+
+        speech = np.zeros(0, dtype=bool)
+        if len(samples):
+            energies = self.frame_energies(samples)
+            # the quietest frames of the turn are taken as its noise floor
+            noise_floor = np.percentile(energies, 10)
+            speech = energies > max(min(noise_floor + self.margin_db, self.max_threshold_db), self.min_speech_db)
+
+        with self.lock:
+            self.turns += 1
+            self.seconds_in += seconds_in
+
+            if np.count_nonzero(speech) < self.min_speech_frames:
+                self.rejected += 1
+                self.seconds_removed += seconds_in
+                return None, seconds_in
+
+            speech_frames = np.flatnonzero(speech)
+            first = max(0, speech_frames[0] - self.padding_frames)
+            last = min(len(speech), speech_frames[-1] + 1 + self.padding_frames)
+            start, end = first * self.frame_size, min(len(samples), last * self.frame_size)
+
+            seconds_removed = (len(samples) - (end - start)) / self.sample_rate
+            self.seconds_removed += seconds_removed
+
+        return samples[start:end].tobytes(), seconds_removed
+
+    # stt_real_time_factor : stt processing seconds per second of audio, to estimate the stt time saved
+    def stats(self, stt_real_time_factor=0.0):
+        with self.lock:
+            return {
+                "turns": self.turns,
+                "rejected_silent_turns": self.rejected,
+                "seconds_in": round(self.seconds_in, 1),
+                "seconds_removed": round(self.seconds_removed, 1),
+                "removed_ratio": (self.seconds_removed / self.seconds_in) if self.seconds_in else 0.0,
+                "stt_seconds_saved_estimate": round(self.seconds_removed * stt_real_time_factor, 1),
+            }